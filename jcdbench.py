@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+
+import jcd.common
+import jcd.dao
+
+import jcdstats
+
+class Generator(object):
+
+    def __init__(self, arguments):
+        self._arguments = arguments
+        assert self._arguments is not None
+
+    def _get_file_path(self, date):
+        schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+        return os.path.join(self._arguments.datadir, filename)
+
+    def _get_samples(self, date):
+        start = int((datetime.datetime.strptime(date, "%Y-%m-%d") -
+                     datetime.datetime(1970, 1, 1)).total_seconds())
+        period = 86400 // self._arguments.samples
+        for contract_id in xrange(1, self._arguments.contracts + 1):
+            for station_number in xrange(1, self._arguments.stations + 1):
+                capacity = random.randint(10, 40)
+                bikes = random.randint(0, capacity)
+                for index in xrange(self._arguments.samples):
+                    # stations do not change at every sample
+                    if random.random() < self._arguments.change_ratio:
+                        bikes = max(0, min(capacity, bikes + random.randint(-3, 3)))
+                    timestamp = start + index * period + random.randint(0, period - 1)
+                    yield (timestamp, contract_id, station_number, bikes, capacity - bikes)
+
+    def run(self, date):
+        random.seed("%s-%s" % (self._arguments.seed, date))
+        file_path = self._get_file_path(date)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        # the archive is created by the dao, as the collector does, so that
+        # the batch is measured against the production schema and indexes
+        with jcd.common.SqliteDB(os.path.basename(file_path), self._arguments.datadir) as db:
+            jcd.dao.ShortSamplesDAO(db).create_archive_table("main")
+            db.execute_many(
+                '''
+                INSERT OR REPLACE INTO %s (
+                    timestamp,
+                    contract_id,
+                    station_number,
+                    available_bikes,
+                    available_bike_stands)
+                VALUES (?, ?, ?, ?, ?)
+                ''' % jcd.dao.ShortSamplesDAO.TableNameArchive,
+                self._get_samples(date),
+                "Database error while generating samples of %s" % date)
+            db.commit()
+        if self._arguments.verbose:
+            print "Generated", file_path
+
+class Benchmark(object):
+
+    def __init__(self, arguments, statdbname):
+        self._arguments = arguments
+        self._statdbname = statdbname
+        assert self._arguments is not None
+        assert self._statdbname is not None
+        self._results = []
+
+    def _count_samples(self, db, schema):
+        counts = db.execute_fetch_generator(
+            "SELECT COUNT(*) AS samples FROM %s.%s" % (
+                schema, jcd.dao.ShortSamplesDAO.TableNameArchive),
+            None,
+            "Database error while counting samples",
+            True)
+        return next(counts)["samples"]
+
+    def _time_stage(self, name, date, samples, function, *args):
+        begin = time.time()
+        function(*args)
+        duration = time.time() - begin
+        self._results.append({
+            "stage": name,
+            "date": date,
+            "duration": duration,
+            "samples": samples,
+            "rate": samples / duration if duration > 0 else 0.0,
+            # peak of the whole process so far, it never decreases
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        })
+
+    def _run_date(self, db, schema, date):
+        samples = self._count_samples(db, schema)
+        minmax = jcdstats.MinMax(db, schema, self._arguments)
+        activity = jcdstats.Activity(db, schema, self._arguments)
+        occupancy = jcdstats.Occupancy(db, schema, self._arguments)
+        quantiles = jcdstats.Quantiles(db, schema, self._arguments)
+        if self._arguments.engine == "scan":
+            day = {}
+            def read():
+                day.update(jcdstats.read_day(db, schema, self._arguments, date))
+            self._time_stage("scan_read_day", date, samples, read)
+            self._time_stage("minmax_store_day", date, samples, minmax.store_day, day)
+            self._time_stage("activity_store_day", date, samples, activity.store_day, day)
+            self._time_stage("occupancy_store_day", date, samples, occupancy.store_day, day)
+            self._time_stage("quantiles_store_day", date, samples, quantiles.store_day, day)
+        else:
+            self._time_stage("minmax_stations", date, samples, minmax._do_stations, date)
+            self._time_stage("minmax_contracts", date, samples, minmax._do_contracts, date)
+            self._time_stage("activity_day", date, samples, activity.run_day, date)
+            self._time_stage("occupancy_day", date, samples, occupancy.run_day, date)
+            self._time_stage("quantiles_day", date, samples, quantiles.run_day, date)
+        self._time_stage("minmax_aggregates", date, samples, minmax.run_aggregates, date)
+        self._time_stage("occupancy_contracts", date, samples, occupancy.run_aggregates, date)
+        self._time_stage("activity_day_aggregates", date, samples, activity.run_day_aggregates, date)
+        self._time_stage("activity_week_aggregates", date, samples, activity.run_week_aggregates, date)
+        self._time_stage("activity_month_aggregates", date, samples, activity.run_month_aggregates, date)
+        self._time_stage("activity_year_aggregates", date, samples, activity.run_year_aggregates, date)
+        self._time_stage("quantiles_aggregates", date, samples, quantiles.run_aggregates, date)
+
+    def run(self, dates):
+        with jcd.common.SqliteDB(self._statdbname, self._arguments.datadir) as db:
+            jcdstats.apply_profile(db, self._arguments.profile, self._arguments.verbose)
+            db = jcdstats.TableCache(db)
+            for date in dates:
+                schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+                filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+                db.attach_database(filename, schema, self._arguments.datadir)
+                self._run_date(db, schema, date)
+                db.commit()
+                db.detach_database(schema)
+        return self._results
+
+    @staticmethod
+    def report(results):
+        print "%-26s %-10s %10s %10s %14s %12s" % (
+            "stage", "date", "seconds", "samples", "samples/s", "peak_rss_kb")
+        totals = {}
+        for result in results:
+            print "%-26s %-10s %10.4f %10i %14.0f %12i" % (
+                result["stage"], result["date"], result["duration"],
+                result["samples"], result["rate"], result["peak_rss"])
+            totals[result["stage"]] = totals.get(result["stage"], 0.0) + result["duration"]
+        print
+        for stage in sorted(totals, key=totals.get, reverse=True):
+            print "%-26s %10.4f" % (stage, totals[stage])
+
+class Golden(object):
+
+    def __init__(self, arguments):
+        self._arguments = arguments
+        assert self._arguments is not None
+
+    def _get_tables(self, db):
+        tables = db.execute_fetch_generator(
+            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name",
+            None,
+            "Database error while listing tables",
+            True)
+        return [table["name"] for table in tables]
+
+    def _get_rows(self, db, table_name):
+        rows = db.execute_fetch_generator(
+            "SELECT * FROM %s" % table_name,
+            None,
+            "Database error while reading table [%s]" % table_name,
+            True)
+        return sorted(tuple(sorted(row.items())) for row in rows)
+
+    def run(self, golden_statdbname, statdbname):
+        # every table of the reference db must be identical in the other one
+        mismatches = 0
+        with jcd.common.SqliteDB(golden_statdbname, self._arguments.datadir) as golden:
+            with jcd.common.SqliteDB(statdbname, self._arguments.datadir) as candidate:
+                tables = self._get_tables(candidate)
+                for table_name in self._get_tables(golden):
+                    if table_name not in tables:
+                        print "Missing table", table_name
+                        mismatches += 1
+                        continue
+                    expected = self._get_rows(golden, table_name)
+                    actual = self._get_rows(candidate, table_name)
+                    if expected != actual:
+                        print "Mismatch in table %s (%i rows expected, %i found)" % (
+                            table_name, len(expected), len(actual))
+                        mismatches += 1
+                    elif self._arguments.verbose:
+                        print "Identical table %s (%i rows)" % (table_name, len(expected))
+        return mismatches
+
+class App(object):
+
+    def __init__(self):
+        # construct parser
+        self._parser = argparse.ArgumentParser(
+            description='Benchmark jcd stats on synthetic samples')
+        self._parser.add_argument(
+            '--datadir',
+            help='choose data folder (default: a temporary folder)'
+        )
+        self._parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='keep generated data folder'
+        )
+        self._parser.add_argument(
+            '--date',
+            default='2016-01-01',
+            help='first date to generate (default: 2016-01-01)'
+        )
+        self._parser.add_argument(
+            '--days',
+            type=int,
+            default=3,
+            help='number of days to generate (default: 3)'
+        )
+        self._parser.add_argument(
+            '--contracts',
+            type=int,
+            default=5,
+            help='number of contracts (default: 5)'
+        )
+        self._parser.add_argument(
+            '--stations',
+            type=int,
+            default=200,
+            help='number of stations per contract (default: 200)'
+        )
+        self._parser.add_argument(
+            '--samples',
+            type=int,
+            default=288,
+            help='number of samples per station and day (default: 288)'
+        )
+        self._parser.add_argument(
+            '--change-ratio',
+            type=float,
+            default=0.3,
+            help='probability that a sample changes a station (default: 0.3)'
+        )
+        self._parser.add_argument(
+            '--seed',
+            default='jcd',
+            help='random seed (default: jcd)'
+        )
+        self._parser.add_argument(
+            '--engine',
+            choices=['sql', 'scan', 'numpy'],
+            default='sql',
+            help='daily stages engine to benchmark (default: sql)'
+        )
+        self._parser.add_argument(
+            '--rollup',
+            choices=['full', 'delta'],
+            default='full',
+            help='rollup mode to benchmark (default: full)'
+        )
+        self._parser.add_argument(
+            '--profile',
+            choices=sorted(jcdstats.SqliteProfiles),
+            default='safe',
+            help='sqlite performance profile of the stats db (default: safe)'
+        )
+        self._parser.add_argument(
+            '--check',
+            action='store_true',
+            help='compare stats with a reference run (sql engine, full rollups)'
+        )
+        self._parser.add_argument(
+            '--verbose', '-v',
+            action='store_true',
+            help='display operationnal informations'
+        )
+
+    def run(self):
+        # parse arguments
+        arguments = self._parser.parse_args()
+        if arguments.samples < 1 or arguments.samples > 86400:
+            self._parser.error("--samples must be between 1 and 86400")
+        temporary = arguments.datadir is None
+        if temporary:
+            arguments.datadir = tempfile.mkdtemp(prefix="jcdbench_")
+        elif not os.path.isdir(arguments.datadir):
+            os.makedirs(arguments.datadir)
+        # stats classes expect the batch arguments
+        arguments.incremental = False
+        arguments.jobs = 1
+        arguments.change_log = False
+        arguments.count = "samples"
+        arguments.quantile_width = 1
+        arguments.partition = "none"
+        try:
+            first = datetime.datetime.strptime(arguments.date, "%Y-%m-%d")
+            dates = [(first + datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+                     for day in xrange(arguments.days)]
+            generator = Generator(arguments)
+            for date in dates:
+                generator.run(date)
+            results = Benchmark(arguments, "stats.db").run(dates)
+            Benchmark.report(results)
+            if arguments.check:
+                reference = argparse.Namespace(**vars(arguments))
+                reference.engine = "sql"
+                reference.rollup = "full"
+                Benchmark(reference, "golden.db").run(dates)
+                mismatches = Golden(arguments).run("golden.db", "stats.db")
+                if mismatches > 0:
+                    print "Golden check failed: %i tables differ" % mismatches
+                    return 1
+                print "Golden check passed"
+            return 0
+        finally:
+            if temporary and not arguments.keep:
+                shutil.rmtree(arguments.datadir)
+            elif arguments.verbose:
+                print "Data kept in", arguments.datadir
+
+# main
+if __name__ == '__main__':
+    try:
+        sys.exit(App().run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,341 @@
+#! /usr/bin/env python
+
+import sys
+import argparse
+import datetime
+import threading
+import collections
+
+import jcd.common
+
+import jcdstats
+
+from jcdstats import Activity
+
+# ranked tables of stations and contracts, with their time key
+Periods = {
+    "day": (Activity.StationsDayTable, Activity.ContractsDayTable, "start_of_day"),
+    "week": (Activity.StationsWeekTable, Activity.ContractsWeekTable, "start_of_week"),
+    "month": (Activity.StationsMonthTable, Activity.ContractsMonthTable, "start_of_month"),
+    "year": (Activity.StationsYearTable, Activity.ContractsYearTable, "start_of_year"),
+    "7days": (Activity.Stations7DaysTable, Activity.Contracts7DaysTable, "start_of_day"),
+    "30days": (Activity.Stations30DaysTable, Activity.Contracts30DaysTable, "start_of_day")
+}
+
+def get_period_start(period, date):
+    # same periods as the batch, trailing windows are keyed on their last day
+    day = datetime.datetime.strptime(date, "%Y-%m-%d")
+    if period == "week":
+        day -= datetime.timedelta(days=day.weekday())
+    elif period == "month":
+        day = day.replace(day=1)
+    elif period == "year":
+        day = day.replace(month=1, day=1)
+    return int((day - datetime.datetime(1970, 1, 1)).total_seconds())
+
+def get_period_year(period, date):
+    # partitions store periods in the year they start in
+    return datetime.datetime.utcfromtimestamp(get_period_start(period, date)).year
+
+class RankCache(object):
+
+    def __init__(self, size):
+        self._size = size
+        assert self._size > 0
+        # results by (stats db, table, period), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, query):
+        with self._lock:
+            results = self._entries.pop(key, None)
+            if results is None:
+                return None
+            self._entries[key] = results
+            return results.get(query)
+
+    def put(self, key, query, rows):
+        with self._lock:
+            results = self._entries.pop(key, {})
+            results[query] = rows
+            self._entries[key] = results
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# shared by the queries of this process
+Cache = RankCache(256)
+
+class ActivityQuery(object):
+
+    # partitions kept attached between queries, below the attach limit
+    MaxYears = 8
+
+    def __init__(self, db, cache=None, partitions=None):
+        self._db = db
+        assert self._db is not None
+        self._cache = cache
+        if self._cache is None:
+            self._cache = Cache
+        self._partitions = partitions
+        self._years = set()
+        self._data_versions = None
+        # the cache is shared by queries of other stats dbs, in memory dbs
+        # having no file are told apart by their connection
+        self._file = self._get_main_file() or id(self._db)
+
+    def _get_main_file(self):
+        schemas = self._db.execute_fetch_generator(
+            "PRAGMA database_list",
+            None,
+            "Database error while listing databases",
+            True)
+        return [schema["file"] for schema in schemas if schema["name"] == "main"][0]
+
+    def _open_years(self, first_year, last_year):
+        # year partitions, when the stats db has them, are read through
+        # views over the attached years
+        if self._partitions is None:
+            return
+        years = set(xrange(first_year, last_year + 1))
+        if years <= self._years:
+            return
+        if len(years | self._years) <= self.MaxYears:
+            years |= self._years
+        self._partitions.open(years)
+        self._years = years
+
+    def _get_data_versions(self):
+        schemas = self._db.execute_fetch_generator(
+            "PRAGMA database_list",
+            None,
+            "Database error while listing databases",
+            True)
+        versions = {}
+        for schema_name in [schema["name"] for schema in schemas if schema["name"] != "temp"]:
+            rows = self._db.execute_fetch_generator(
+                "PRAGMA %s.data_version" % schema_name,
+                None,
+                "Database error while reading data version of [%s]" % schema_name,
+                True)
+            versions[schema_name] = next(rows)["data_version"]
+        return versions
+
+    def _check_data_version(self):
+        # commits of other connections, such as a batch running in another
+        # process, may have rewritten any period of any attached db, and
+        # partitions attached since the last check may have been written
+        # while they were not
+        versions = self._get_data_versions()
+        if self._data_versions is not None and any(
+                self._data_versions.get(schema_name) != version
+                for schema_name, version in versions.iteritems()):
+            self._cache.clear()
+        self._data_versions = versions
+
+    def _get_cached(self, table_name, period, date, query, sql, params):
+        year = get_period_year(period, date)
+        self._open_years(year, year)
+        self._check_data_version()
+        key = (self._file, table_name, params["period"])
+        rows = self._cache.get(key, query)
+        if rows is None:
+            rows = list(self._db.execute_fetch_generator(
+                sql,
+                params,
+                "Database error while reading table [%s]" % table_name,
+                True))
+            self._cache.put(key, query, rows)
+        return list(rows)
+
+    def get_top_stations(self, period, date, limit=10, contract_id=None):
+        stations_table, contracts_table, time_key_name = Periods[period]
+        params = {
+            "period": get_period_start(period, date),
+            "contract_id": contract_id,
+            "limit": limit
+        }
+        if contract_id is None:
+            # served by the (time, rank_global) index, ties being ordered
+            # by the primary key it ends with
+            sql = '''
+                SELECT contract_id,
+                    station_number,
+                    num_changes,
+                    rank_contract,
+                    rank_global
+                FROM %s
+                WHERE %s = :period
+                ORDER BY rank_global, contract_id, station_number
+                LIMIT :limit
+                ''' % (stations_table, time_key_name)
+        else:
+            # served by the (time, contract_id, rank_contract) index
+            sql = '''
+                SELECT contract_id,
+                    station_number,
+                    num_changes,
+                    rank_contract,
+                    rank_global
+                FROM %s
+                WHERE %s = :period AND
+                    contract_id = :contract_id
+                ORDER BY rank_contract, station_number
+                LIMIT :limit
+                ''' % (stations_table, time_key_name)
+        return self._get_cached(
+            stations_table, period, date, ("stations", contract_id, limit), sql, params)
+
+    def get_top_contracts(self, period, date, limit=10):
+        stations_table, contracts_table, time_key_name = Periods[period]
+        params = {
+            "period": get_period_start(period, date),
+            "limit": limit
+        }
+        sql = '''
+            SELECT contract_id,
+                num_changes,
+                rank_global
+            FROM %s
+            WHERE %s = :period
+            ORDER BY rank_global, contract_id
+            LIMIT :limit
+            ''' % (contracts_table, time_key_name)
+        return self._get_cached(
+            contracts_table, period, date, ("contracts", limit), sql, params)
+
+    def get_station_history(self, period, contract_id, station_number, first_date, last_date):
+        # spans many periods, so it is not cached
+        stations_table, contracts_table, time_key_name = Periods[period]
+        self._open_years(get_period_year(period, first_date), get_period_year(period, last_date))
+        return list(self._db.execute_fetch_generator(
+            '''
+            SELECT strftime('%%Y-%%m-%%d', %s, 'unixepoch') AS date,
+                num_changes,
+                rank_contract,
+                rank_global
+            FROM %s
+            WHERE contract_id = :contract_id AND
+                station_number = :station_number AND
+                %s BETWEEN :first AND :last
+            ORDER BY %s
+            ''' % (time_key_name, stations_table, time_key_name, time_key_name),
+            {
+                "contract_id": contract_id,
+                "station_number": station_number,
+                "first": get_period_start(period, first_date),
+                "last": get_period_start(period, last_date)
+            },
+            "Database error while reading table [%s]" % stations_table,
+            True))
+
+class App(object):
+
+    def __init__(self, default_data_path, default_statdb_filename):
+        # construct parser
+        self._parser = argparse.ArgumentParser(
+            description='Query station and contract activity ranks from jcd stats')
+        self._parser.add_argument(
+            '--datadir',
+            help='choose data folder (default: %s)' % default_data_path,
+            default=default_data_path
+        )
+        self._parser.add_argument(
+            '--statdbname',
+            help='choose stats db filename (default: %s)' % default_statdb_filename,
+            default=default_statdb_filename
+        )
+        self._parser.add_argument(
+            '--period',
+            choices=['day', 'week', 'month', 'year', '7days', '30days'],
+            default='day',
+            help='period containing the date, trailing windows end on it (default: day)'
+        )
+        self._parser.add_argument(
+            '--limit',
+            type=int,
+            default=10,
+            help='number of ranked items to display (default: 10)'
+        )
+        self._parser.add_argument(
+            '--contract',
+            type=int,
+            help='rank stations within this contract'
+        )
+        self._parser.add_argument(
+            '--contracts',
+            action='store_true',
+            help='rank contracts instead of stations'
+        )
+        self._parser.add_argument(
+            '--station',
+            type=int,
+            help='display the rank history of this station of --contract'
+        )
+        self._parser.add_argument(
+            '--to',
+            dest='date_to',
+            metavar='DATE',
+            help='last date of the station history (default: date)'
+        )
+        self._parser.add_argument(
+            '--verbose', '-v',
+            action='store_true',
+            help='display operationnal informations'
+        )
+        self._parser.add_argument(
+            'date',
+            metavar='date',
+            type=str,
+            help='a date of the period to query (YYYY-MM-DD)')
+
+    def run(self):
+        # parse arguments
+        arguments = self._parser.parse_args()
+        if arguments.limit < 1:
+            self._parser.error("--limit must be at least 1")
+        if arguments.station is not None and arguments.contract is None:
+            self._parser.error("--station requires --contract")
+        if arguments.contracts and arguments.contract is not None:
+            self._parser.error("--contracts can not be used with --contract")
+        if arguments.date_to is None:
+            arguments.date_to = arguments.date
+        for date in (arguments.date, arguments.date_to):
+            try:
+                datetime.datetime.strptime(date, "%Y-%m-%d")
+            except ValueError as error:
+                self._parser.error("invalid date: %s" % error)
+        with jcd.common.SqliteDB(arguments.statdbname, arguments.datadir) as db:
+            partitions = jcdstats.Partitions(db, arguments, False)
+            if len(partitions.get_years()) == 0:
+                partitions = None
+            query = ActivityQuery(db, partitions=partitions)
+            if arguments.station is not None:
+                print "%-10s %10s %12s %10s" % ("date", "changes", "rank_contract", "rank_global")
+                for row in query.get_station_history(
+                        arguments.period, arguments.contract, arguments.station,
+                        arguments.date, arguments.date_to):
+                    print "%-10s %10i %12s %10s" % (
+                        row["date"], row["num_changes"], row["rank_contract"], row["rank_global"])
+            elif arguments.contracts:
+                print "%6s %10s %10s" % ("rank", "contract", "changes")
+                for row in query.get_top_contracts(arguments.period, arguments.date, arguments.limit):
+                    print "%6s %10i %10i" % (row["rank_global"], row["contract_id"], row["num_changes"])
+            else:
+                rank_name = "rank_global" if arguments.contract is None else "rank_contract"
+                print "%6s %10s %10s %10s" % ("rank", "contract", "station", "changes")
+                for row in query.get_top_stations(
+                        arguments.period, arguments.date, arguments.limit, arguments.contract):
+                    print "%6s %10i %10i %10i" % (
+                        row[rank_name], row["contract_id"], row["station_number"], row["num_changes"])
+        return 0
+
+# main
+if __name__ == '__main__':
+    try:
+        sys.exit(App("~/.jcd_v2", "stats.db").run())
+    except KeyboardInterrupt:
+        pass
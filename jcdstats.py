@@ -1,26 +1,420 @@
 #! /usr/bin/env python
 
+import io
+import os
+import re
 import sys
+import json
+import time
 import sqlite3
 import argparse
+import datetime
+import urllib
+import threading
+import functools
+import multiprocessing
 
 import jcd.common
 import jcd.dao
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# ranking is done in sql when window functions are available
+HasWindowFunctions = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+# closed daily sample dbs are attached as immutable uri filenames
+HasUriFilenames = sqlite3.connect(":memory:").execute(
+    "SELECT sqlite_compileoption_used('USE_URI')").fetchone()[0] == 1
+
+# seconds a sample db of a closed day must be left unchanged before it
+# is attached as immutable, late samples may still be added until then
+ImmutableGracePeriod = 86400
+
+# pragmas applied to the stats db when it is opened, a None value keeps
+# the sqlite default; backfill trades crash safety for speed, so a crash
+# during a backfill may require rebuilding the stats db
+SqliteProfiles = {
+    "safe": [
+        ("journal_mode", None),
+        ("synchronous", "FULL"),
+        ("cache_size", -16384),
+        ("temp_store", "MEMORY"),
+        ("mmap_size", 268435456)
+    ],
+    "backfill": [
+        ("journal_mode", "MEMORY"),
+        ("synchronous", "OFF"),
+        ("cache_size", -524288),
+        ("temp_store", "MEMORY"),
+        ("mmap_size", 1073741824)
+    ]
+}
+
+def get_profile_pragma(profile, name):
+    return dict(SqliteProfiles[profile])[name]
+
+def apply_profile(db, profile, verbose):
+    for name, value in SqliteProfiles[profile]:
+        if value is None:
+            continue
+        if verbose:
+            print "Setting pragma", name, "to", value
+        db.execute_single(
+            "PRAGMA %s = %s" % (name, value),
+            None,
+            "Database error while setting pragma [%s]" % name)
+
+def set_autocommit(db):
+    # python 2 sqlite3 commits implicitly before DDL, ATTACH and PRAGMA
+    # statements, so the stats connection is left in autocommit mode and
+    # its transactions are delimited explicitly
+    set_isolation_level = getattr(db, "set_isolation_level", None)
+    if set_isolation_level is not None:
+        set_isolation_level(None)
+        return
+    # jcd.common.SqliteDB does not expose its connection, which is then
+    # looked up in its attributes; this relies on SqliteDB keeping a single
+    # sqlite3 connection, and fails rather than guessing
+    connections = [value for value in vars(db).itervalues()
+                   if isinstance(value, sqlite3.Connection)]
+    assert len(connections) == 1, "expected a single sqlite3 connection in %r" % db
+    connection = connections[0]
+    # temp objects only exist on their connection
+    db.execute_single(
+        "CREATE TEMP TABLE set_autocommit_check (id INTEGER)",
+        None,
+        "Database error while checking the stats connection")
+    assert connection.execute(
+        "SELECT COUNT(*) FROM sqlite_temp_master WHERE name = 'set_autocommit_check'").fetchone()[0] == 1
+    connection.execute("DROP TABLE temp.set_autocommit_check")
+    connection.isolation_level = None
+
+class Transaction(object):
+
+    def __init__(self, db):
+        self._db = db
+        assert self._db is not None
+
+    def __enter__(self):
+        self._db.execute_single(
+            "BEGIN",
+            None,
+            "Database error while beginning transaction")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # nothing of a failed transaction is kept
+        if exc_type is None:
+            self._db.execute_single(
+                "COMMIT",
+                None,
+                "Database error while committing transaction")
+        else:
+            self._db.execute_single(
+                "ROLLBACK",
+                None,
+                "Database error while rolling back transaction")
+        return False
+
+def get_day_bounds(db, date):
+    # same boundaries as the activity queries
+    bounds = db.execute_fetch_generator(
+        '''
+        SELECT CAST(%s AS INTEGER) AS first,
+            CAST(%s AS INTEGER) AS last
+        ''' % (Activity.DayStart, Activity.DayEnd),
+        {"date": date},
+        "Database error while getting day boundaries",
+        True)
+    return next(bounds)
+
+def get_count_select(arguments):
+    # change log rows stand for runs of identical samples
+    if arguments.change_log and arguments.count == "samples":
+        return "SUM(samples)"
+    return "COUNT(timestamp)"
+
+def get_partition_table(arguments, table_name, date):
+    # rows are written in the partition of the year of their time key,
+    # reads go through the views over the attached partitions
+    if arguments.partition != "year":
+        return table_name
+    day = datetime.datetime.strptime(date, "%Y-%m-%d")
+    if table_name in Partitions.WeekTables:
+        day -= datetime.timedelta(days=day.weekday())
+    return "%s.%s" % (Partitions.get_schema(day.year), table_name)
+
+class TableCache(object):
+
+    def __init__(self, db):
+        self._db = db
+        assert self._db is not None
+        self._types = {}
+
+    def __getattr__(self, name):
+        # anything not cached goes straight to the db
+        return getattr(self._db, name)
+
+    def _get_type(self, name):
+        # station tables are views in the compact layout, and partitioned
+        # tables are temporary views over the attached years
+        types = self._db.execute_fetch_generator(
+            '''
+            SELECT type FROM sqlite_master WHERE name = :name
+            UNION ALL
+            SELECT type FROM sqlite_temp_master WHERE name = :name
+            ''',
+            {"name": name},
+            "Database error while looking for [%s]" % name,
+            True)
+        return next(types, {"type": None})["type"]
+
+    def get_type(self, name):
+        # tables, views and indexes are never dropped, so only found ones
+        # are remembered
+        if name not in self._types:
+            object_type = self._get_type(name)
+            if object_type is None:
+                return None
+            self._types[name] = object_type
+        return self._types[name]
+
+    def has_table(self, name):
+        return self.get_type(name) in ("table", "view")
+
+class Instrumentation(object):
+
+    ExplainedStatements = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+    def __init__(self, db, arguments):
+        self._db = db
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._arguments is not None
+        self._started = time.time()
+        self._stages = []
+        self._current = []
+
+    def __getattr__(self, name):
+        # anything not instrumented goes straight to the db
+        return getattr(self._db, name)
+
+    @staticmethod
+    def _get_stage_date(args):
+        for arg in args:
+            if isinstance(arg, basestring):
+                return arg
+            if isinstance(arg, dict) and "date" in arg:
+                return arg["date"]
+        return None
+
+    def begin_stage(self, name, args):
+        self._current.append({
+            "run": int(self._started),
+            "pid": os.getpid(),
+            "stage": name,
+            "parent": self._current[-1]["stage"] if len(self._current) > 0 else None,
+            "date": self._get_stage_date(args),
+            "started": time.time(),
+            "duration": None,
+            "exclusive": None,
+            "nested": 0.0,
+            "rows_fetched": 0,
+            "rows_written": 0,
+            "queries": 0,
+            "plans": []
+        })
+
+    def end_stage(self):
+        # stages may nest, duration includes nested stages and exclusive
+        # time does not, so that exclusive times add up to the run time
+        stage = self._current.pop()
+        stage["duration"] = time.time() - stage["started"]
+        stage["exclusive"] = stage["duration"] - stage.pop("nested")
+        if len(self._current) > 0:
+            self._current[-1]["nested"] += stage["duration"]
+        if not self._arguments.metrics_plans:
+            del stage["plans"]
+        self._stages.append(stage)
+
+    def get_stages(self):
+        return list(self._stages)
+
+    def add_stages(self, stages):
+        # stages of worker processes are reported with this run
+        for stage in stages:
+            stage["run"] = int(self._started)
+            self._stages.append(stage)
+
+    def _get_plan(self, sql, params):
+        rows = self._db.execute_fetch_generator(
+            "EXPLAIN QUERY PLAN %s" % sql,
+            params,
+            "Database error while explaining query",
+            True)
+        return {
+            "query": " ".join(sql.split()),
+            "plan": [row["detail"] for row in rows]
+        }
+
+    def _record(self, sql, params, written=0, explain=True):
+        if len(self._current) == 0:
+            return None
+        stage = self._current[-1]
+        stage["queries"] += 1
+        if written > 0:
+            stage["rows_written"] += written
+        # only data statements have a query plan
+        if explain and sql.split(None, 1)[0].upper() not in self.ExplainedStatements:
+            explain = False
+        if self._arguments.metrics_plans and explain:
+            stage["plans"].append(self._get_plan(sql, params))
+        return stage
+
+    def _count_rows(self, rows, stage):
+        for row in rows:
+            stage["rows_fetched"] += 1
+            yield row
+
+    def execute_single(self, sql, params, error_message):
+        written = self._db.execute_single(sql, params, error_message)
+        self._record(sql, params, written)
+        return written
+
+    def execute_many(self, sql, iterable, error_message):
+        written = self._db.execute_many(sql, iterable, error_message)
+        self._record(sql, None, written, False)
+        return written
+
+    def execute_fetch_generator(self, sql, params, error_message, dict_factory=False):
+        rows = self._db.execute_fetch_generator(sql, params, error_message, dict_factory)
+        stage = self._record(sql, params)
+        if stage is None:
+            return rows
+        return self._count_rows(rows, stage)
+
+    def _write_jsonl(self, output):
+        for stage in self._stages:
+            output.write(json.dumps(stage, sort_keys=True))
+            output.write("\n")
+
+    def _write_prometheus(self, output):
+        totals = {}
+        for stage in self._stages:
+            total = totals.setdefault(stage["stage"], {
+                "count": 0,
+                "duration": 0.0,
+                "rows_fetched": 0,
+                "rows_written": 0
+            })
+            total["count"] += 1
+            total["duration"] += stage["exclusive"]
+            total["rows_fetched"] += stage["rows_fetched"]
+            total["rows_written"] += stage["rows_written"]
+        for metric, key, help_text in (
+                ("jcdstats_stage_runs", "count", "Number of times a stage ran"),
+                ("jcdstats_stage_duration_seconds", "duration",
+                 "Time spent in a stage excluding nested stages, summed over worker processes"),
+                ("jcdstats_stage_rows_fetched", "rows_fetched",
+                 "Rows fetched into python by a stage, rows read by sql statements are not counted"),
+                ("jcdstats_stage_rows_written", "rows_written", "Rows written by a stage")):
+            output.write("# HELP %s %s\n" % (metric, help_text))
+            output.write("# TYPE %s gauge\n" % metric)
+            for name in sorted(totals):
+                output.write("%s{stage=\"%s\"} %s\n" % (metric, name, totals[name][key]))
+        output.write("# HELP jcdstats_run_duration_seconds Time spent in the whole run\n")
+        output.write("# TYPE jcdstats_run_duration_seconds gauge\n")
+        output.write("jcdstats_run_duration_seconds %s\n" % (time.time() - self._started))
+        output.write("# HELP jcdstats_run_timestamp_seconds Start time of the run\n")
+        output.write("# TYPE jcdstats_run_timestamp_seconds gauge\n")
+        output.write("jcdstats_run_timestamp_seconds %i\n" % self._started)
+
+    def reset(self):
+        self._started = time.time()
+        self._stages = []
+        self._current = []
+
+    def write(self):
+        filename = os.path.expanduser(self._arguments.metrics)
+        if self._arguments.metrics_format == "jsonl":
+            # one line per stage, appended run after run
+            with open(filename, "a") as output:
+                self._write_jsonl(output)
+        else:
+            # textfiles are replaced atomically for the collector
+            with open("%s.tmp" % filename, "w") as output:
+                self._write_prometheus(output)
+            os.rename("%s.tmp" % filename, filename)
+
+def stage(name):
+    # records duration and rows of a stage when its db is instrumented
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not isinstance(self._db, Instrumentation):
+                return method(self, *args, **kwargs)
+            self._db.begin_stage(name.format(*args), args)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._db.end_stage()
+        return wrapper
+    return decorator
+
 class MinMax(object):
 
     StationsDayTable = "minmax_stations_day"
     ContractsDayTable = "minmax_contracts_day"
     GlobalsDayTable = "minmax_global_day"
 
-    def __init__(self, db, sample_schema, arguments):
+    StationsWeekTable = "minmax_stations_week"
+    ContractsWeekTable = "minmax_contracts_week"
+    GlobalsWeekTable = "minmax_global_week"
+
+    StationsMonthTable = "minmax_stations_month"
+    ContractsMonthTable = "minmax_contracts_month"
+    GlobalsMonthTable = "minmax_global_month"
+
+    StationsYearTable = "minmax_stations_year"
+    ContractsYearTable = "minmax_contracts_year"
+    GlobalsYearTable = "minmax_global_year"
+
+    # tables by time key
+    StationsTables = {
+        "start_of_day": StationsDayTable,
+        "start_of_week": StationsWeekTable,
+        "start_of_month": StationsMonthTable,
+        "start_of_year": StationsYearTable
+    }
+    ContractsTables = {
+        "start_of_day": ContractsDayTable,
+        "start_of_week": ContractsWeekTable,
+        "start_of_month": ContractsMonthTable,
+        "start_of_year": ContractsYearTable
+    }
+    GlobalsTables = {
+        "start_of_day": GlobalsDayTable,
+        "start_of_week": GlobalsWeekTable,
+        "start_of_month": GlobalsMonthTable,
+        "start_of_year": GlobalsYearTable
+    }
+
+    def __init__(self, db, sample_schema, arguments, create_tables=True, samples_by_station=None):
         self._db = db
         self._sample_schema = sample_schema
         self._arguments = arguments
         assert self._db is not None
         assert self._sample_schema is not None
         assert self._arguments is not None
-        self._create_tables_if_necessary()
+        # station ordered reads may use a sorted copy of the archive
+        self._samples_by_station = samples_by_station
+        if self._samples_by_station is None:
+            self._samples_by_station = "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive)
+        if create_tables:
+            self._create_tables_if_necessary()
 
     def _create_tables_if_necessary(self):
         if not self._db.has_table(self.StationsDayTable):
@@ -29,6 +423,13 @@ class MinMax(object):
             self._create_contracts_day_table()
         if not self._db.has_table(self.GlobalsDayTable):
             self._create_globals_day_table()
+        for time_key_name in ("start_of_week", "start_of_month", "start_of_year"):
+            if not self._db.has_table(self.StationsTables[time_key_name]):
+                self._create_table_stations_custom(self.StationsTables[time_key_name], time_key_name)
+            if not self._db.has_table(self.ContractsTables[time_key_name]):
+                self._create_table_contracts_custom(self.ContractsTables[time_key_name], time_key_name)
+            if not self._db.has_table(self.GlobalsTables[time_key_name]):
+                self._create_table_global_custom(self.GlobalsTables[time_key_name], time_key_name)
 
     def _create_stations_day_table(self):
         if self._arguments.verbose:
@@ -81,6 +482,57 @@ class MinMax(object):
             None,
             "Database error while creating table [%s]" % self.GlobalsDayTable)
 
+    def _create_table_stations_custom(self, table_name, time_key_name):
+        if self._arguments.verbose:
+            print "Creating table", table_name
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                %s INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                min_bikes INTEGER NOT NULL,
+                max_bikes INTEGER NOT NULL,
+                min_slots INTEGER NOT NULL,
+                max_slots INTEGER NOT NULL,
+                num_changes INTEGER NOT NULL,
+                PRIMARY KEY (%s, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % (table_name, time_key_name, time_key_name),
+            None,
+            "Database error while creating table [%s]" % table_name)
+
+    def _create_table_contracts_custom(self, table_name, time_key_name):
+        if self._arguments.verbose:
+            print "Creating table", table_name
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                %s INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                min_bikes INTEGER NOT NULL,
+                max_bikes INTEGER NOT NULL,
+                PRIMARY KEY (%s, contract_id)
+            ) WITHOUT ROWID;
+            ''' % (table_name, time_key_name, time_key_name),
+            None,
+            "Database error while creating table [%s]" % table_name)
+
+    def _create_table_global_custom(self, table_name, time_key_name):
+        if self._arguments.verbose:
+            print "Creating table", table_name
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                %s INTEGER NOT NULL,
+                min_bikes INTEGER NOT NULL,
+                max_bikes INTEGER NOT NULL,
+                PRIMARY KEY (%s)
+            ) WITHOUT ROWID;
+            ''' % (table_name, time_key_name, time_key_name),
+            None,
+            "Database error while creating table [%s]" % table_name)
+
     def _get_operation_samples(self, operation):
         return self._db.execute_fetch_generator(
             '''
@@ -89,11 +541,9 @@ class MinMax(object):
                 station_number,
                 available_bikes,
                 available_bike_stands
-            FROM %s.%s
+            FROM %s
             GROUP BY contract_id, station_number
-            ''' % (operation,
-                   self._sample_schema,
-                   jcd.dao.ShortSamplesDAO.TableNameArchive),
+            ''' % (operation, self._samples_by_station),
             None,
             "Database error while getting boundary samples",
             True)
@@ -104,34 +554,81 @@ class MinMax(object):
     def _get_last_samples(self):
         return self._get_operation_samples("max")
 
+    def _get_stations_select(self):
+        return '''
+            SELECT strftime('%%s', ?, 'start of day') AS start_of_day,
+                contract_id,
+                station_number,
+                MIN(available_bikes) AS min_bikes,
+                MAX(available_bikes) AS max_bikes,
+                MIN(available_bike_stands) AS min_slots,
+                MAX(available_bike_stands) AS max_slots,
+                %s AS num_changes
+            FROM %s
+            GROUP BY contract_id, station_number
+            ''' % (get_count_select(self._arguments), self._samples_by_station)
+
+    def get_stations(self, date):
+        return self._db.execute_fetch_generator(
+            self._get_stations_select(),
+            (date,),
+            "Database error while getting daily station min max",
+            True)
+
+    @stage("minmax_stations")
     def _do_stations(self, date):
         if self._arguments.verbose:
             print "Update table", self.StationsDayTable, "for", date,
         inserted = self._db.execute_single(
             '''
             INSERT OR REPLACE INTO %s
-                SELECT strftime('%%s', ?, 'start of day'),
-                    contract_id,
-                    station_number,
-                    MIN(available_bikes),
-                    MAX(available_bikes),
-                    MIN(available_bike_stands),
-                    MAX(available_bike_stands),
-                    COUNT(timestamp)
-                FROM %s.%s
-                GROUP BY contract_id, station_number
-            ''' % (self.StationsDayTable,
-                   self._sample_schema,
-                   jcd.dao.ShortSamplesDAO.TableNameArchive),
+            %s
+            ''' % (get_partition_table(self._arguments, self.StationsDayTable, date),
+                   self._get_stations_select()),
             (date,),
             "Database error while storing daily station min max into table [%s]" % self.StationsDayTable)
         if self._arguments.verbose:
             print "... %i records" % inserted
         return inserted
 
-    def _do_contracts(self, date):
+    @stage("store minmax_stations_day")
+    def _store_stations(self, date, stations):
         if self._arguments.verbose:
-            print "Update table", self.ContractsDayTable, "for", date,
+            print "Update table", self.StationsDayTable, "for", date,
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                start_of_day,
+                contract_id,
+                station_number,
+                min_bikes,
+                max_bikes,
+                min_slots,
+                max_slots,
+                num_changes)
+            VALUES(
+                :start_of_day,
+                :contract_id,
+                :station_number,
+                :min_bikes,
+                :max_bikes,
+                :min_slots,
+                :max_slots,
+                :num_changes)
+            ''' % get_partition_table(self._arguments, self.StationsDayTable, date),
+            stations,
+            "Database error while storing daily station min max into table [%s]" % self.StationsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    @stage("minmax_contracts")
+    def get_contracts(self, date):
+        if self._arguments.engine == "numpy" and numpy is not None:
+            return self._get_contracts_numpy(date)
+        return self._get_contracts_python(date)
+
+    def _get_contracts_python(self, date):
         contracts = {}
         # initialize with first sample
         samples = self._get_first_samples()
@@ -177,7 +674,82 @@ class MinMax(object):
                     contract["max"] = contract["cur"]
                 if delta < 0 and contract["cur"] < contract["min"]:
                     contract["min"] = contract["cur"]
-        # write to db
+        # station states are only needed during analysis
+        for contract in contracts.itervalues():
+            del contract["stations"]
+        return contracts.values()
+
+    def _get_contracts_numpy(self, date):
+        # read every sample in chronological order, same as python version
+        samples = self._db.execute_fetch_generator(
+            '''
+            SELECT contract_id,
+                station_number,
+                available_bikes
+            FROM %s.%s
+            ORDER BY timestamp ASC
+            ''' % (self._sample_schema,
+                jcd.dao.ShortSamplesDAO.TableNameArchive),
+            None,
+            "Database error while getting daily samples",
+            True)
+        columns = ([], [], [])
+        for sample in samples:
+            columns[0].append(sample["contract_id"])
+            columns[1].append(sample["station_number"])
+            columns[2].append(sample["available_bikes"])
+        if len(columns[0]) == 0:
+            return []
+        contract_ids = numpy.array(columns[0], dtype=numpy.int64)
+        station_numbers = numpy.array(columns[1], dtype=numpy.int64)
+        bikes = numpy.array(columns[2], dtype=numpy.int64)
+        # group samples by station, keeping chronological order inside groups
+        by_station = numpy.lexsort((numpy.arange(len(bikes)), station_numbers, contract_ids))
+        station_bikes = bikes[by_station]
+        station_starts = numpy.ones(len(bikes), dtype=bool)
+        station_starts[1:] = \
+            (contract_ids[by_station][1:] != contract_ids[by_station][:-1]) | \
+            (station_numbers[by_station][1:] != station_numbers[by_station][:-1])
+        # bikes delta from previous sample of the same station, zero for the first one
+        station_deltas = numpy.zeros(len(bikes), dtype=numpy.int64)
+        station_deltas[1:] = numpy.diff(station_bikes)
+        station_deltas[station_starts] = 0
+        deltas = numpy.empty_like(station_deltas)
+        deltas[by_station] = station_deltas
+        # running total per contract, relative to the sum of first samples
+        by_contract = numpy.argsort(contract_ids, kind="mergesort")
+        sorted_contracts = contract_ids[by_contract]
+        contract_starts = numpy.flatnonzero(numpy.concatenate(
+            ([True], sorted_contracts[1:] != sorted_contracts[:-1])))
+        offsets = numpy.cumsum(deltas[by_contract])
+        offsets -= numpy.repeat(
+            offsets[contract_starts] - deltas[by_contract][contract_starts],
+            numpy.diff(numpy.append(contract_starts, len(offsets))))
+        min_offsets = numpy.minimum.reduceat(offsets, contract_starts)
+        max_offsets = numpy.maximum.reduceat(offsets, contract_starts)
+        # sum of first samples per contract
+        first_indices = numpy.flatnonzero(station_starts)
+        first_contracts = contract_ids[by_station][first_indices]
+        first_sums = {}
+        for contract_id, first_bikes in zip(first_contracts.tolist(), station_bikes[first_indices].tolist()):
+            first_sums[contract_id] = first_sums.get(contract_id, 0) + first_bikes
+        contracts = []
+        for contract_id, min_offset, max_offset in zip(
+                sorted_contracts[contract_starts].tolist(),
+                min_offsets.tolist(),
+                max_offsets.tolist()):
+            contracts.append({
+                "date": date,
+                "contract_id": contract_id,
+                "min": first_sums[contract_id] + min(min_offset, 0),
+                "max": first_sums[contract_id] + max(max_offset, 0)
+            })
+        return contracts
+
+    @stage("store minmax_contracts_day")
+    def _store_contracts(self, date, contracts):
+        if self._arguments.verbose:
+            print "Update table", self.ContractsDayTable, "for", date,
         inserted = self._db.execute_many(
             '''
             INSERT OR REPLACE INTO %s (
@@ -190,13 +762,17 @@ class MinMax(object):
                 :contract_id,
                 :min,
                 :max)
-            ''' % self.ContractsDayTable,
-            contracts.itervalues(),
+            ''' % get_partition_table(self._arguments, self.ContractsDayTable, date),
+            contracts,
             "Database error while storing daily contract min max into table [%s]" % self.ContractsDayTable)
         if self._arguments.verbose:
             print "... %i records" % inserted
         return inserted
 
+    def _do_contracts(self, date):
+        return self._store_contracts(date, self.get_contracts(date))
+
+    @stage("minmax_globals")
     def _do_globals(self, date):
         if self._arguments.verbose:
             print "Update table", self.GlobalsDayTable, "for", date,
@@ -210,17 +786,115 @@ class MinMax(object):
                 FROM %s
                 WHERE start_of_day = strftime('%%s', ?, 'start of day')
                 GROUP BY start_of_day
-            ''' % (self.GlobalsDayTable, self.ContractsDayTable),
+            ''' % (get_partition_table(self._arguments, self.GlobalsDayTable, date), self.ContractsDayTable),
             (date,),
             "Database error while storing daily global min max into table [%s]" % self.ContractsDayTable)
         if self._arguments.verbose:
             print "... %i records" % inserted
         return inserted
 
-    def run(self, date):
+    def store_day(self, day):
+        self._store_stations(day["date"], day["minmax_stations"])
+        self._store_contracts(day["date"], day["minmax_contracts"])
+
+    @stage("{0[target_table]}")
+    def _rollup_custom(self, params):
+        if self._arguments.verbose:
+            print "Update table", params["target_table"], "for", params["date"],
+        # extremes of a period are the extremes of its days
+        inserted = self._db.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s
+                SELECT %s,
+                    %s
+                FROM %s
+                WHERE %s BETWEEN %s AND %s
+                GROUP BY %s
+            ''' % (get_partition_table(self._arguments, params["target_table"], params["date"]),
+                   params["time_select"],
+                   params["columns_select"],
+                   params["source_table"],
+                   params["where_select"],
+                   params["between_first"],
+                   params["between_last"],
+                   params["group_select"]),
+            params,
+            "Database error while storing min max into table [%s]" % params["target_table"])
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    def _rollup_period(self, params):
+        time_key_name = params["time_key_name"]
+        source_key_name = params["where_select"]
+        for target_table, source_table, group_select, columns_select in (
+                (self.StationsTables[time_key_name], self.StationsTables[source_key_name],
+                 "contract_id, station_number",
+                 "contract_id, station_number, MIN(min_bikes), MAX(max_bikes), "
+                 "MIN(min_slots), MAX(max_slots), SUM(num_changes)"),
+                (self.ContractsTables[time_key_name], self.ContractsTables[source_key_name],
+                 "contract_id",
+                 "contract_id, MIN(min_bikes), MAX(max_bikes)"),
+                (self.GlobalsTables[time_key_name], self.GlobalsTables[source_key_name],
+                 None,
+                 "MIN(min_bikes), MAX(max_bikes)")):
+            table_params = dict(params)
+            table_params.update({
+                "target_table": target_table,
+                "source_table": source_table,
+                "columns_select": columns_select,
+                "group_select": ", ".join(
+                    column for column in (params["time_select"], group_select) if column is not None)
+            })
+            self._rollup_custom(table_params)
+
+    def run_day_aggregates(self, date):
+        self._do_globals(date)
+
+    def run_week_aggregates(self, date):
+        self._rollup_period({
+            "date": date,
+            "time_key_name": "start_of_week",
+            "time_select": Activity.WeekOfDay,
+            "where_select": "start_of_day",
+            "between_first": Activity.WeekStart,
+            "between_last": Activity.WeekEnd
+        })
+
+    def run_month_aggregates(self, date):
+        self._rollup_period({
+            "date": date,
+            "time_key_name": "start_of_month",
+            "time_select": Activity.MonthOfDay,
+            "where_select": "start_of_day",
+            "between_first": Activity.MonthStart,
+            "between_last": Activity.MonthEnd
+        })
+
+    def run_year_aggregates(self, date):
+        # yearly, built from months
+        self._rollup_period({
+            "date": date,
+            "time_key_name": "start_of_year",
+            "time_select": Activity.YearOfMonth,
+            "where_select": "start_of_month",
+            "between_first": Activity.YearStart,
+            "between_last": Activity.YearEnd
+        })
+
+    def run_aggregates(self, date):
+        self.run_day_aggregates(date)
+        self.run_week_aggregates(date)
+        self.run_month_aggregates(date)
+        self.run_year_aggregates(date)
+
+    def run_day(self, date):
         self._do_stations(date)
         self._do_contracts(date)
-        self._do_globals(date)
+
+    def run(self, date):
+        self.run_day(date)
+        self.run_aggregates(date)
 
 class Activity(object):
 
@@ -240,16 +914,72 @@ class Activity(object):
     ContractsYearTable = "activity_contracts_year"
     GlobalYearTable = "activity_global_year"
 
-    def __init__(self, db, sample_schema, arguments):
+    # windows of days ending on each day
+    Stations7DaysTable = "activity_stations_7days"
+    Contracts7DaysTable = "activity_contracts_7days"
+    Stations30DaysTable = "activity_stations_30days"
+    Contracts30DaysTable = "activity_contracts_30days"
+    TrailingTables = (
+        (7, Stations7DaysTable, Contracts7DaysTable),
+        (30, Stations30DaysTable, Contracts30DaysTable)
+    )
+
+    # ranked tables, with their time key
+    StationsRankedTables = (
+        (StationsDayTable, "start_of_day"),
+        (StationsWeekTable, "start_of_week"),
+        (StationsMonthTable, "start_of_month"),
+        (StationsYearTable, "start_of_year"),
+        (Stations7DaysTable, "start_of_day"),
+        (Stations30DaysTable, "start_of_day")
+    )
+    ContractsRankedTables = (
+        (ContractsDayTable, "start_of_day"),
+        (ContractsWeekTable, "start_of_week"),
+        (ContractsMonthTable, "start_of_month"),
+        (ContractsYearTable, "start_of_year"),
+        (Contracts7DaysTable, "start_of_day"),
+        (Contracts30DaysTable, "start_of_day")
+    )
+
+    TempStationsRanksTable = "temp.activity_ranks_stations"
+    TempContractsRanksTable = "temp.activity_ranks_contracts"
+    TempPreviousDayTable = "temp.activity_previous_day"
+    TempDeltaDayTable = "temp.activity_delta_day"
+
+    DayStart = "strftime('%s', :date, 'start of day')"
+    WeekStart = "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')"
+    MonthStart = "strftime('%s', :date, 'start of month')"
+    YearStart = "strftime('%s', :date, 'start of year')"
+    DayEnd = "strftime('%s', :date, 'start of day', '+1 day') - 1"
+    WeekEnd = "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day', '+7 days') - 1"
+    MonthEnd = "strftime('%s', :date, 'start of month', '+1 month') - 1"
+    YearEnd = "strftime('%s', :date, 'start of year', '+1 year') - 1"
+    # periods of rows, by their own time column
+    DayOfSample = "strftime('%s', timestamp, 'unixepoch', 'start of day')"
+    WeekOfDay = "start_of_day - strftime('%w', start_of_day, 'unixepoch', '-1 day') * 86400"
+    MonthOfDay = "strftime('%s', start_of_day, 'unixepoch', 'start of month')"
+    YearOfMonth = "strftime('%s', start_of_month, 'unixepoch', 'start of year')"
+
+    def __init__(self, db, sample_schema, arguments, create_tables=True, samples_by_station=None):
         self._db = db
         self._sample_schema = sample_schema
         self._arguments = arguments
         assert self._db is not None
         assert self._sample_schema is not None
         assert self._arguments is not None
-        self._create_tables_if_necessary()
+        # station ordered reads may use a sorted copy of the archive
+        self._samples_by_station = samples_by_station
+        if self._samples_by_station is None:
+            self._samples_by_station = "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive)
+        if create_tables:
+            self._create_tables_if_necessary()
 
     def _create_tables_if_necessary(self):
+        if not HasWindowFunctions:
+            self._create_temp_ranks_tables_if_necessary()
+        if self._arguments.rollup == "delta":
+            self._create_temp_delta_tables_if_necessary()
         if not self._db.has_table(self.StationsDayTable):
             self._create_table_stations_custom(self.StationsDayTable, "start_of_day")
         if not self._db.has_table(self.ContractsDayTable):
@@ -278,6 +1008,38 @@ class Activity(object):
         if not self._db.has_table(self.GlobalYearTable):
             self._create_table_global_custom(self.GlobalYearTable, "start_of_year")
 
+        for days, stations_table, contracts_table in self.TrailingTables:
+            if not self._db.has_table(stations_table):
+                self._create_table_stations_custom(stations_table, "start_of_day")
+            if not self._db.has_table(contracts_table):
+                self._create_table_contracts_custom(contracts_table, "start_of_day")
+        self._create_rank_indexes_if_necessary()
+
+    def _create_index(self, index_name, table_name, columns):
+        if self._arguments.verbose:
+            print "Creating index", index_name
+        self._db.execute_single(
+            "CREATE INDEX %s ON %s (%s)" % (index_name, table_name, ", ".join(columns)),
+            None,
+            "Database error while creating index [%s]" % index_name)
+
+    def _create_rank_indexes_if_necessary(self):
+        # top lists and station histories are read by rank and by station,
+        # tables held elsewhere (views) are indexed where they are stored
+        indexes = []
+        for table_name, time_key_name in self.StationsRankedTables:
+            indexes.extend([
+                (table_name + "_rank_global", table_name, (time_key_name, "rank_global")),
+                (table_name + "_rank_contract", table_name, (time_key_name, "contract_id", "rank_contract")),
+                (table_name + "_station", table_name, ("contract_id", "station_number", time_key_name))
+            ])
+        for table_name, time_key_name in self.ContractsRankedTables:
+            indexes.append(
+                (table_name + "_rank_global", table_name, (time_key_name, "rank_global")))
+        for index_name, table_name, columns in indexes:
+            if self._db.get_type(table_name) == "table" and self._db.get_type(index_name) is None:
+                self._create_index(index_name, table_name, columns)
+
     def _create_table_stations_custom(self, table_name, time_key_name):
         if self._arguments.verbose:
             print "Creating table", table_name
@@ -326,48 +1088,105 @@ class Activity(object):
             None,
             "Database error while creating table [%s]" % table_name)
 
+    @staticmethod
+    def _get_activity_stations_select(params):
+        return '''
+            SELECT %s AS %s,
+                contract_id,
+                station_number,
+                %s AS num_changes,
+                NULL AS rank_contract,
+                NULL AS rank_global
+            FROM %s
+            WHERE %s BETWEEN %s AND %s
+            GROUP BY contract_id, station_number
+            ''' % (params["time_select"],
+                   params["time_key_name"],
+                   params["aggregate_select"],
+                   params["source_table"],
+                   params["where_select"],
+                   params["between_first"],
+                   params["between_last"])
+
+    @stage("{0[target_table]}")
     def _do_activity_stations_custom(self, params):
         if self._arguments.verbose:
             print "Update table", params["target_table"], "for", params["date"],
         inserted = self._db.execute_single(
             '''
             INSERT OR REPLACE INTO %s
-                SELECT %s,
-                    contract_id,
-                    station_number,
-                    %s,
-                    NULL,
-                    NULL
-                FROM %s
-                WHERE %s BETWEEN %s AND %s
-                GROUP BY contract_id, station_number
-            ''' % (params["target_table"],
-                   params["time_select"],
-                   params["aggregate_select"],
-                   params["source_table"],
-                   params["where_select"],
-                   params["between_first"],
-                   params["between_last"]),
+            %s
+            ''' % (get_partition_table(self._arguments, params["target_table"], params["date"]),
+                   self._get_activity_stations_select(params)),
             params,
             "Database error while storing stations activity into table [%s]" % params["target_table"])
         if self._arguments.verbose:
             print "... %i records" % inserted
         return inserted
 
-    def _do_activity_contracts_custom(self, params):
-        if self._arguments.verbose:
-            print "Update table", params["target_table"], "for", params["date"],
-        inserted = self._db.execute_single(
-            '''
-            INSERT OR REPLACE INTO %s
-                SELECT %s,
-                    contract_id,
-                    SUM(num_changes),
+    def _get_stations_day_params(self, date):
+        return {
+            "date": date,
+            "target_table": self.StationsDayTable,
+            "time_key_name": "start_of_day",
+            "time_select": self.DayOfSample,
+            "aggregate_select": get_count_select(self._arguments),
+            "source_table": self._samples_by_station,
+            "where_select": "timestamp",
+            "between_first": self.DayStart,
+            "between_last": self.DayEnd
+        }
+
+    def get_stations_day(self, date):
+        params = self._get_stations_day_params(date)
+        return self._db.execute_fetch_generator(
+            self._get_activity_stations_select(params),
+            params,
+            "Database error while getting daily stations activity",
+            True)
+
+    @stage("store activity_stations_day")
+    def _store_stations_day(self, date, stations):
+        if self._arguments.verbose:
+            print "Update table", self.StationsDayTable, "for", date,
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                start_of_day,
+                contract_id,
+                station_number,
+                num_changes,
+                rank_contract,
+                rank_global)
+            VALUES(
+                :start_of_day,
+                :contract_id,
+                :station_number,
+                :num_changes,
+                NULL,
+                NULL)
+            ''' % get_partition_table(self._arguments, self.StationsDayTable, date),
+            stations,
+            "Database error while storing stations activity into table [%s]" % self.StationsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    @stage("{0[target_table]}")
+    def _do_activity_contracts_custom(self, params):
+        if self._arguments.verbose:
+            print "Update table", params["target_table"], "for", params["date"],
+        inserted = self._db.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s
+                SELECT %s,
+                    contract_id,
+                    SUM(num_changes),
                     NULL
                 FROM %s
                 WHERE %s
                 GROUP BY contract_id
-            ''' % (params["target_table"],
+            ''' % (get_partition_table(self._arguments, params["target_table"], params["date"]),
                    params["time_select"],
                    params["source_table"],
                    params["where_clause"]),
@@ -377,6 +1196,7 @@ class Activity(object):
             print "... %i records" % inserted
         return inserted
 
+    @stage("{0[target_table]}")
     def _do_activity_global_custom(self, params):
         if self._arguments.verbose:
             print "Update table", params["target_table"], "for", params["date"],
@@ -388,7 +1208,7 @@ class Activity(object):
                 FROM %s
                 WHERE %s
                 GROUP BY %s
-            ''' % (params["target_table"],
+            ''' % (get_partition_table(self._arguments, params["target_table"], params["date"]),
                    params["time_select"],
                    params["source_table"],
                    params["where_clause"],
@@ -447,12 +1267,76 @@ class Activity(object):
             ## return updated item
             yield item
 
+    def _create_temp_ranks_tables_if_necessary(self):
+        # used to bulk apply ranks when window functions are not available
+        self._db.execute_single(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS %s (
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                rank_contract INTEGER,
+                rank_global INTEGER,
+                PRIMARY KEY (contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % self.TempStationsRanksTable,
+            None,
+            "Database error while creating table [%s]" % self.TempStationsRanksTable)
+        self._db.execute_single(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS %s (
+                contract_id INTEGER NOT NULL,
+                rank_global INTEGER,
+                PRIMARY KEY (contract_id)
+            ) WITHOUT ROWID;
+            ''' % self.TempContractsRanksTable,
+            None,
+            "Database error while creating table [%s]" % self.TempContractsRanksTable)
+
+    def _create_temp_delta_tables_if_necessary(self):
+        # used to roll up only daily changes into weeks, months and years
+        for table_name in (self.TempPreviousDayTable, self.TempDeltaDayTable):
+            self._db.execute_single(
+                '''
+                CREATE TEMP TABLE IF NOT EXISTS %s (
+                    contract_id INTEGER NOT NULL,
+                    station_number INTEGER NOT NULL,
+                    num_changes INTEGER NOT NULL,
+                    PRIMARY KEY (contract_id, station_number)
+                ) WITHOUT ROWID;
+                ''' % table_name,
+                None,
+                "Database error while creating table [%s]" % table_name)
+
+    @stage("ranking {2}")
     def _stations_update_ranking_custom(self, params, expr_date, table_name, timefield_name):
+        if HasWindowFunctions:
+            # rank and write the whole period in a single statement
+            updated = self._db.execute_single(
+                '''
+                INSERT OR REPLACE INTO %s (
+                    %s,
+                    contract_id,
+                    station_number,
+                    num_changes,
+                    rank_contract,
+                    rank_global)
+                SELECT %s,
+                    contract_id,
+                    station_number,
+                    num_changes,
+                    RANK() OVER (PARTITION BY contract_id ORDER BY num_changes DESC),
+                    RANK() OVER (ORDER BY num_changes DESC)
+                FROM %s
+                WHERE %s = %s
+                ''' % (get_partition_table(self._arguments, table_name, params["date"]),
+                       timefield_name, timefield_name, table_name, timefield_name, expr_date),
+                params,
+                "Database error while updating %s" % table_name)
+            return updated
         # read from db
         raw_items = self._db.execute_fetch_generator(
             '''
-            SELECT %s,
-                contract_id,
+            SELECT contract_id,
                 station_number,
                 num_changes,
                 rank_contract,
@@ -460,7 +1344,7 @@ class Activity(object):
             FROM %s
             WHERE %s = %s
             ORDER BY num_changes DESC
-            ''' % (timefield_name, table_name, timefield_name, expr_date),
+            ''' % (table_name, timefield_name, expr_date),
             params,
             "Database error while getting activity ranks",
             True)
@@ -471,33 +1355,86 @@ class Activity(object):
             "rank_global",
             "contract_id",
             "rank_contract")
-        # write to db
-        updated = self._db.execute_many(
-            '''
-            UPDATE %s
-            SET rank_global = :rank_global,
-                rank_contract = :rank_contract
-            WHERE %s = :%s AND
-                contract_id = :contract_id AND
-                station_number = :station_number
-            ''' % (table_name, timefield_name, timefield_name),
-            ranked_items,
+        # write ranks to a temp table, then apply them in a single statement
+        self._db.execute_single(
+            "DELETE FROM %s" % self.TempStationsRanksTable,
+            None,
+            "Database error while clearing %s" % self.TempStationsRanksTable)
+        self._db.execute_many(
+            '''
+            INSERT INTO %s (
+                contract_id,
+                station_number,
+                rank_contract,
+                rank_global)
+            VALUES(
+                :contract_id,
+                :station_number,
+                :rank_contract,
+                :rank_global)
+            ''' % self.TempStationsRanksTable,
+            list(ranked_items),
+            "Database error while storing ranks into %s" % self.TempStationsRanksTable)
+        updated = self._db.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s (
+                %s,
+                contract_id,
+                station_number,
+                num_changes,
+                rank_contract,
+                rank_global)
+            SELECT t.%s,
+                t.contract_id,
+                t.station_number,
+                t.num_changes,
+                r.rank_contract,
+                r.rank_global
+            FROM %s AS t
+            JOIN %s AS r ON
+                r.contract_id = t.contract_id AND
+                r.station_number = t.station_number
+            WHERE t.%s = %s
+            ''' % (get_partition_table(self._arguments, table_name, params["date"]),
+                   timefield_name, timefield_name, table_name,
+                   self.TempStationsRanksTable, timefield_name, expr_date),
+            params,
             "Database error while updating %s" % table_name)
         # return number of updated records
         return updated
 
+    @stage("ranking {2}")
     def _contracts_update_ranking_custom(self, params, expr_date, table_name, timefield_name):
+        if HasWindowFunctions:
+            # rank and write the whole period in a single statement
+            updated = self._db.execute_single(
+                '''
+                INSERT OR REPLACE INTO %s (
+                    %s,
+                    contract_id,
+                    num_changes,
+                    rank_global)
+                SELECT %s,
+                    contract_id,
+                    num_changes,
+                    RANK() OVER (ORDER BY num_changes DESC)
+                FROM %s
+                WHERE %s = %s
+                ''' % (get_partition_table(self._arguments, table_name, params["date"]),
+                       timefield_name, timefield_name, table_name, timefield_name, expr_date),
+                params,
+                "Database error while updating %s" % table_name)
+            return updated
         # read from db
         raw_items = self._db.execute_fetch_generator(
             '''
-            SELECT %s,
-                contract_id,
+            SELECT contract_id,
                 num_changes,
                 rank_global
             FROM %s
             WHERE %s = %s
             ORDER BY num_changes DESC
-            ''' % (timefield_name, table_name, timefield_name, expr_date),
+            ''' % (table_name, timefield_name, expr_date),
             params,
             "Database error while getting activity ranks",
             True)
@@ -508,168 +1445,2276 @@ class Activity(object):
             "rank_global",
             None,
             None)
-        # write to db
-        updated = self._db.execute_many(
-            '''
-            UPDATE %s
-            SET rank_global = :rank_global
-            WHERE %s = :%s AND
-                contract_id = :contract_id
-            ''' % (table_name, timefield_name, timefield_name),
-            ranked_items,
+        # write ranks to a temp table, then apply them in a single statement
+        self._db.execute_single(
+            "DELETE FROM %s" % self.TempContractsRanksTable,
+            None,
+            "Database error while clearing %s" % self.TempContractsRanksTable)
+        self._db.execute_many(
+            '''
+            INSERT INTO %s (
+                contract_id,
+                rank_global)
+            VALUES(
+                :contract_id,
+                :rank_global)
+            ''' % self.TempContractsRanksTable,
+            list(ranked_items),
+            "Database error while storing ranks into %s" % self.TempContractsRanksTable)
+        updated = self._db.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s (
+                %s,
+                contract_id,
+                num_changes,
+                rank_global)
+            SELECT t.%s,
+                t.contract_id,
+                t.num_changes,
+                r.rank_global
+            FROM %s AS t
+            JOIN %s AS r ON
+                r.contract_id = t.contract_id
+            WHERE t.%s = %s
+            ''' % (get_partition_table(self._arguments, table_name, params["date"]),
+                   timefield_name, timefield_name, table_name,
+                   self.TempContractsRanksTable, timefield_name, expr_date),
+            params,
             "Database error while updating %s" % table_name)
         # return number of updated records
         return updated
 
-    def run(self, date):
-        # daily station
-        self._do_activity_stations_custom({
-            "date": date,
-            "target_table": self.StationsDayTable,
-            "time_select": "strftime('%s', timestamp, 'unixepoch', 'start of day')",
-            "aggregate_select": "COUNT(timestamp)",
-            "source_table": "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive),
-            "where_select": "timestamp",
-            "between_first": "strftime('%s', :date, 'start of day')",
-            "between_last": "strftime('%s', :date, 'start of day', '+1 day') - 1"
-        })
+    @stage("activity_previous_day")
+    def _save_previous_stations_day(self, date):
+        self._db.execute_single(
+            "DELETE FROM %s" % self.TempPreviousDayTable,
+            None,
+            "Database error while clearing %s" % self.TempPreviousDayTable)
+        self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT contract_id,
+                    station_number,
+                    num_changes
+                FROM %s
+                WHERE start_of_day = %s
+            ''' % (self.TempPreviousDayTable, self.StationsDayTable, self.DayStart),
+            {"date": date},
+            "Database error while saving previous daily stations activity")
+
+    @stage("activity_delta_rollup")
+    def _rollup_stations_day_delta(self, date):
+        # only the difference between new and previous daily counts is rolled up
+        self._db.execute_single(
+            "DELETE FROM %s" % self.TempDeltaDayTable,
+            None,
+            "Database error while clearing %s" % self.TempDeltaDayTable)
+        self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT n.contract_id,
+                    n.station_number,
+                    n.num_changes - COALESCE(o.num_changes, 0)
+                FROM %s AS n
+                LEFT JOIN %s AS o ON
+                    o.contract_id = n.contract_id AND
+                    o.station_number = n.station_number
+                WHERE n.start_of_day = %s AND
+                    n.num_changes != COALESCE(o.num_changes, 0)
+            ''' % (self.TempDeltaDayTable, self.StationsDayTable,
+                   self.TempPreviousDayTable, self.DayStart),
+            {"date": date},
+            "Database error while computing daily stations activity delta")
+        for table_name, time_key_name, expr_date in (
+                (self.StationsWeekTable, "start_of_week", self.WeekStart),
+                (self.StationsMonthTable, "start_of_month", self.MonthStart),
+                (self.StationsYearTable, "start_of_year", self.YearStart)):
+            if self._arguments.verbose:
+                print "Update table", table_name, "for", date,
+            updated = self._db.execute_single(
+                '''
+                INSERT OR REPLACE INTO %s (
+                    %s,
+                    contract_id,
+                    station_number,
+                    num_changes,
+                    rank_contract,
+                    rank_global)
+                SELECT %s,
+                    d.contract_id,
+                    d.station_number,
+                    COALESCE(p.num_changes, 0) + d.num_changes,
+                    p.rank_contract,
+                    p.rank_global
+                FROM %s AS d
+                LEFT JOIN %s AS p ON
+                    p.%s = %s AND
+                    p.contract_id = d.contract_id AND
+                    p.station_number = d.station_number
+                ''' % (get_partition_table(self._arguments, table_name, date),
+                       time_key_name, expr_date, self.TempDeltaDayTable,
+                       table_name, time_key_name, expr_date),
+                {"date": date},
+                "Database error while applying stations activity delta into table [%s]" % table_name)
+            if self._arguments.verbose:
+                print "... %i records" % updated
+
+    def _has_trailing_day(self, params, table_name):
+        days = self._db.execute_fetch_generator(
+            '''
+            SELECT COUNT(*) AS days
+            FROM (
+                SELECT start_of_day
+                FROM %s
+                WHERE start_of_day = %s - 86400
+                LIMIT 1
+            )
+            ''' % (table_name, self.DayStart),
+            params,
+            "Database error while reading table [%s]" % table_name,
+            True)
+        return next(days)["days"] > 0
+
+    def _get_trailing_later_dates(self, params, table_name):
+        # windows ending after this day still contain it, those from the
+        # next day still waiting for its aggregates on are refreshed by it
+        pending = ""
+        if self._db.has_table(DirtyAggregates.AggregatesTable):
+            pending = '''AND
+                start_of_day < IFNULL((
+                    SELECT MIN(period)
+                    FROM %s
+                    WHERE level = 'day' AND
+                        period > %s), start_of_day + 1)
+                ''' % (DirtyAggregates.AggregatesTable, self.DayStart)
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT DISTINCT strftime('%%Y-%%m-%%d', start_of_day, 'unixepoch') AS date
+            FROM %s
+            WHERE start_of_day > %s AND
+                start_of_day < %s + :days * 86400
+                %s
+            ORDER BY start_of_day
+            ''' % (table_name, self.DayStart, self.DayStart, pending),
+            params,
+            "Database error while reading table [%s]" % table_name,
+            True)
+
+    @stage("{2}")
+    def _do_activity_stations_trailing(self, date, days, table_name):
+        if self._arguments.verbose:
+            print "Update table", table_name, "for", date,
+        params = {"date": date, "days": days}
+        if self._has_trailing_day(params, table_name):
+            # previous window, plus the new day, minus the day leaving it
+            select = '''
+                SELECT contract_id,
+                    station_number,
+                    num_changes
+                FROM %s
+                WHERE start_of_day = %s - 86400
+                UNION ALL
+                SELECT contract_id,
+                    station_number,
+                    num_changes
+                FROM %s
+                WHERE start_of_day = %s
+                UNION ALL
+                SELECT contract_id,
+                    station_number,
+                    -num_changes
+                FROM %s
+                WHERE start_of_day = %s - :days * 86400
+                ''' % (table_name, self.DayStart,
+                       self.StationsDayTable, self.DayStart,
+                       self.StationsDayTable, self.DayStart)
+        else:
+            # first window, summed from days
+            select = '''
+                SELECT contract_id,
+                    station_number,
+                    num_changes
+                FROM %s
+                WHERE start_of_day BETWEEN %s - (:days - 1) * 86400 AND %s
+                ''' % (self.StationsDayTable, self.DayStart, self.DayStart)
+        self._db.execute_single(
+            '''
+            DELETE FROM %s
+            WHERE start_of_day = %s
+            ''' % (get_partition_table(self._arguments, table_name, date), self.DayStart),
+            params,
+            "Database error while clearing table [%s]" % table_name)
+        inserted = self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT %s,
+                    contract_id,
+                    station_number,
+                    SUM(num_changes),
+                    NULL,
+                    NULL
+                FROM (%s)
+                GROUP BY contract_id, station_number
+                HAVING SUM(num_changes) > 0
+            ''' % (get_partition_table(self._arguments, table_name, date), self.DayStart, select),
+            params,
+            "Database error while storing trailing stations activity into table [%s]" % table_name)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    def _run_trailing_day_aggregates(self, date, days, stations_table, contracts_table):
+        # trailing station
+        self._do_activity_stations_trailing(date, days, stations_table)
         self._stations_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, 'start of day')",
-            self.StationsDayTable,
+            self.DayStart,
+            stations_table,
             "start_of_day")
-        # weekly station
-        self._do_activity_stations_custom({
-            "date": date,
-            "target_table": self.StationsWeekTable,
-            "time_select": "start_of_day - strftime('%w', start_of_day, 'unixepoch', '-1 day') * 86400",
-            "aggregate_select": "SUM(num_changes)",
-            "source_table": self.StationsDayTable,
-            "where_select": "start_of_day",
-            "between_first": "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')",
-            "between_last": "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day', '+7 days') - 1"
-        })
-        self._stations_update_ranking_custom(
+        # trailing contract
+        self._db.execute_single(
+            '''
+            DELETE FROM %s
+            WHERE start_of_day = %s
+            ''' % (get_partition_table(self._arguments, contracts_table, date), self.DayStart),
             {"date": date},
-            "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')",
-            self.StationsWeekTable,
-            "start_of_week")
-        # monthly station
-        self._do_activity_stations_custom({
+            "Database error while clearing table [%s]" % contracts_table)
+        self._do_activity_contracts_custom({
             "date": date,
-            "target_table": self.StationsMonthTable,
-            "time_select": "strftime('%s', start_of_day, 'unixepoch', 'start of month')",
-            "aggregate_select": "SUM(num_changes)",
-            "source_table": self.StationsDayTable,
-            "where_select": "start_of_day",
-            "between_first": "strftime('%s', :date, 'start of month')",
-            "between_last": "strftime('%s', :date, 'start of month', '+1 month') - 1"
+            "target_table": contracts_table,
+            "time_select": "start_of_day",
+            "source_table": stations_table,
+            "where_clause": "start_of_day = %s" % self.DayStart,
         })
-        self._stations_update_ranking_custom(
+        self._contracts_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, 'start of month')",
-            self.StationsMonthTable,
-            "start_of_month")
-        # yearly station
-        self._do_activity_stations_custom({
-            "date": date,
-            "target_table": self.StationsYearTable,
-            "time_select": "strftime('%s', start_of_month, 'unixepoch', 'start of year')",
-            "aggregate_select": "SUM(num_changes)",
-            "source_table": self.StationsMonthTable,
-            "where_select": "start_of_month",
-            "between_first": "strftime('%s', :date, 'start of year')",
-            "between_last": "strftime('%s', :date, 'start of year', '+1 year') - 1"
-        })
+            self.DayStart,
+            contracts_table,
+            "start_of_day")
+
+    def run_trailing_aggregates(self, date):
+        for days, stations_table, contracts_table in self.TrailingTables:
+            # dates are usually processed in order, so that later windows
+            # only exist when a previous date is processed again
+            later = [row["date"] for row in self._get_trailing_later_dates(
+                {"date": date, "days": days}, stations_table)]
+            for current in [date] + later:
+                self._run_trailing_day_aggregates(current, days, stations_table, contracts_table)
+
+    def _rollup_stations_custom(self, params):
+        # delta rollups are applied as soon as the day is stored
+        if self._arguments.rollup == "delta":
+            return 0
+        return self._do_activity_stations_custom(params)
+
+    def store_day(self, day):
+        delta = self._arguments.rollup == "delta"
+        if delta:
+            self._save_previous_stations_day(day["date"])
+        self._store_stations_day(day["date"], day["activity_stations"])
+        if delta:
+            self._rollup_stations_day_delta(day["date"])
+
+    def run_day(self, date):
+        # daily station
+        delta = self._arguments.rollup == "delta"
+        if delta:
+            self._save_previous_stations_day(date)
+        self._do_activity_stations_custom(self._get_stations_day_params(date))
+        if delta:
+            self._rollup_stations_day_delta(date)
+
+    def run(self, date):
+        self.run_day(date)
+        self.run_aggregates(date)
+
+    def get_periods(self, date):
+        periods = self._db.execute_fetch_generator(
+            '''
+            SELECT %s AS day,
+                %s AS week,
+                %s AS month,
+                %s AS year
+            ''' % (self.DayStart, self.WeekStart, self.MonthStart, self.YearStart),
+            {"date": date},
+            "Database error while getting periods",
+            True)
+        return next(periods)
+
+    def run_day_aggregates(self, date):
+        # daily station
         self._stations_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, 'start of year')",
-            self.StationsYearTable,
-            "start_of_year")
+            self.DayStart,
+            self.StationsDayTable,
+            "start_of_day")
         # daily contract
         self._do_activity_contracts_custom({
             "date": date,
             "target_table": self.ContractsDayTable,
             "time_select": "start_of_day",
             "source_table": self.StationsDayTable,
-            "where_clause": "start_of_day = strftime('%s', :date, 'start of day')",
+            "where_clause": "start_of_day = %s" % self.DayStart,
         })
         self._contracts_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, 'start of day')",
+            self.DayStart,
             self.ContractsDayTable,
             "start_of_day")
+        # daily global
+        self._do_activity_global_custom({
+            "date": date,
+            "target_table": self.GlobalDayTable,
+            "time_select": "start_of_day",
+            "source_table": self.ContractsDayTable,
+            "where_clause": "start_of_day = %s" % self.DayStart,
+        })
+        # trailing windows ending on this day
+        self.run_trailing_aggregates(date)
+
+    def run_week_aggregates(self, date):
+        # weekly station
+        self._rollup_stations_custom({
+            "date": date,
+            "target_table": self.StationsWeekTable,
+            "time_key_name": "start_of_week",
+            "time_select": self.WeekOfDay,
+            "aggregate_select": "SUM(num_changes)",
+            "source_table": self.StationsDayTable,
+            "where_select": "start_of_day",
+            "between_first": self.WeekStart,
+            "between_last": self.WeekEnd
+        })
+        self._stations_update_ranking_custom(
+            {"date": date},
+            self.WeekStart,
+            self.StationsWeekTable,
+            "start_of_week")
         # weekly contract
         self._do_activity_contracts_custom({
             "date": date,
             "target_table": self.ContractsWeekTable,
             "time_select": "start_of_week",
             "source_table": self.StationsWeekTable,
-            "where_clause": "start_of_week = strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')",
+            "where_clause": "start_of_week = %s" % self.WeekStart,
         })
         self._contracts_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')",
+            self.WeekStart,
             self.ContractsWeekTable,
             "start_of_week")
+        # weekly global
+        self._do_activity_global_custom({
+            "date": date,
+            "target_table": self.GlobalWeekTable,
+            "time_select": "start_of_week",
+            "source_table": self.ContractsWeekTable,
+            "where_clause": "start_of_week = %s" % self.WeekStart,
+        })
+
+    def run_month_aggregates(self, date):
+        # monthly station
+        self._rollup_stations_custom({
+            "date": date,
+            "target_table": self.StationsMonthTable,
+            "time_key_name": "start_of_month",
+            "time_select": self.MonthOfDay,
+            "aggregate_select": "SUM(num_changes)",
+            "source_table": self.StationsDayTable,
+            "where_select": "start_of_day",
+            "between_first": self.MonthStart,
+            "between_last": self.MonthEnd
+        })
+        self._stations_update_ranking_custom(
+            {"date": date},
+            self.MonthStart,
+            self.StationsMonthTable,
+            "start_of_month")
         # monthly contract
         self._do_activity_contracts_custom({
             "date": date,
             "target_table": self.ContractsMonthTable,
             "time_select": "start_of_month",
             "source_table": self.StationsMonthTable,
-            "where_clause": "start_of_month = strftime('%s', :date, 'start of month')",
+            "where_clause": "start_of_month = %s" % self.MonthStart,
         })
         self._contracts_update_ranking_custom(
             {"date": date},
-            "strftime('%s', :date, 'start of month')",
+            self.MonthStart,
             self.ContractsMonthTable,
             "start_of_month")
-        # yearly contract
-        self._do_activity_contracts_custom({
+        # monthly global
+        self._do_activity_global_custom({
             "date": date,
-            "target_table": self.ContractsYearTable,
-            "time_select": "start_of_year",
-            "source_table": self.StationsYearTable,
-            "where_clause": "start_of_year = strftime('%s', :date, 'start of year')",
+            "target_table": self.GlobalMonthTable,
+            "time_select": "start_of_month",
+            "source_table": self.ContractsMonthTable,
+            "where_clause": "start_of_month = %s" % self.MonthStart,
         })
-        self._contracts_update_ranking_custom(
-            {"date": date},
-            "strftime('%s', :date, 'start of year')",
-            self.ContractsYearTable,
-            "start_of_year")
-        # daily global
-        self._do_activity_global_custom({
+
+    def run_year_aggregates(self, date):
+        # yearly station, built from months
+        self._rollup_stations_custom({
             "date": date,
-            "target_table": self.GlobalDayTable,
-            "time_select": "start_of_day",
-            "source_table": self.ContractsDayTable,
-            "where_clause": "start_of_day = strftime('%s', :date, 'start of day')",
+            "target_table": self.StationsYearTable,
+            "time_key_name": "start_of_year",
+            "time_select": self.YearOfMonth,
+            "aggregate_select": "SUM(num_changes)",
+            "source_table": self.StationsMonthTable,
+            "where_select": "start_of_month",
+            "between_first": self.YearStart,
+            "between_last": self.YearEnd
         })
-        # weekly global
-        self._do_activity_global_custom({
+        self._stations_update_ranking_custom(
+            {"date": date},
+            self.YearStart,
+            self.StationsYearTable,
+            "start_of_year")
+        # yearly contract
+        self._do_activity_contracts_custom({
             "date": date,
-            "target_table": self.GlobalWeekTable,
-            "time_select": "start_of_week",
-            "source_table": self.ContractsWeekTable,
-            "where_clause": "start_of_week = strftime('%s', :date, '-' || strftime('%w', :date, '-1 day') || ' days', 'start of day')",
+            "target_table": self.ContractsYearTable,
+            "time_select": "start_of_year",
+            "source_table": self.StationsYearTable,
+            "where_clause": "start_of_year = %s" % self.YearStart,
         })
-        # monthly global
+        self._contracts_update_ranking_custom(
+            {"date": date},
+            self.YearStart,
+            self.ContractsYearTable,
+            "start_of_year")
+        # yearly global
         self._do_activity_global_custom({
             "date": date,
-            "target_table": self.GlobalMonthTable,
-            "time_select": "start_of_month",
-            "source_table": self.ContractsMonthTable,
-            "where_clause": "start_of_month = strftime('%s', :date, 'start of month')",
+            "target_table": self.GlobalYearTable,
+            "time_select": "start_of_year",
+            "source_table": self.ContractsYearTable,
+            "where_clause": "start_of_year = %s" % self.YearStart,
         })
-        # yearly global
-        self._do_activity_global_custom({
+
+    def run_aggregates(self, date):
+        self.run_day_aggregates(date)
+        self.run_week_aggregates(date)
+        self.run_month_aggregates(date)
+        self.run_year_aggregates(date)
+
+class Occupancy(object):
+
+    StationsDayTable = "occupancy_stations_day"
+    ContractsDayTable = "occupancy_contracts_day"
+
+    def __init__(self, db, sample_schema, arguments, create_tables=True):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+        if create_tables:
+            self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        if not self._db.has_table(self.StationsDayTable):
+            self._create_stations_day_table()
+        if not self._db.has_table(self.ContractsDayTable):
+            self._create_contracts_day_table()
+
+    def _create_stations_day_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.StationsDayTable
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                start_of_day INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                avg_bikes REAL NOT NULL,
+                empty_seconds INTEGER NOT NULL,
+                full_seconds INTEGER NOT NULL,
+                seconds INTEGER NOT NULL,
+                PRIMARY KEY (start_of_day, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % self.StationsDayTable,
+            None,
+            "Database error while creating table [%s]" % self.StationsDayTable)
+
+    def _create_contracts_day_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.ContractsDayTable
+        # durations are summed over stations
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                start_of_day INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                avg_bikes REAL NOT NULL,
+                empty_seconds INTEGER NOT NULL,
+                full_seconds INTEGER NOT NULL,
+                PRIMARY KEY (start_of_day, contract_id)
+            ) WITHOUT ROWID;
+            ''' % self.ContractsDayTable,
+            None,
+            "Database error while creating table [%s]" % self.ContractsDayTable)
+
+    def _get_samples(self):
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands
+            FROM %s.%s
+            ORDER BY timestamp ASC
+            ''' % (self._sample_schema,
+                jcd.dao.ShortSamplesDAO.TableNameArchive),
+            None,
+            "Database error while getting daily samples",
+            True)
+
+    @staticmethod
+    def add_interval(station, begin, end):
+        # the state of the previous sample lasts until this one, within the day
+        seconds = end - begin
+        if seconds <= 0:
+            return
+        station["weighted_bikes"] += station["bikes"] * seconds
+        station["seconds"] += seconds
+        if station["bikes"] == 0:
+            station["empty_seconds"] += seconds
+        if station["slots"] == 0:
+            station["full_seconds"] += seconds
+
+    @staticmethod
+    def get_rows(stations, first, end):
+        # last samples last until the end of the day, which is not part of
+        # the state a later scan may resume from
+        rows = []
+        for station in stations:
+            row = {
+                "start_of_day": first,
+                "contract_id": station["contract_id"],
+                "station_number": station["station_number"],
+                "bikes": station["bikes"],
+                "slots": station["slots"],
+                "weighted_bikes": station["weighted_bikes"],
+                "empty_seconds": station["empty_seconds"],
+                "full_seconds": station["full_seconds"],
+                "seconds": station["seconds"]
+            }
+            Occupancy.add_interval(row, max(station["timestamp"], first), end)
+            if row["seconds"] == 0:
+                continue
+            row["avg_bikes"] = float(row["weighted_bikes"]) / row["seconds"]
+            rows.append(row)
+        return rows
+
+    @stage("occupancy_stations")
+    def get_stations(self, date):
+        bounds = get_day_bounds(self._db, date)
+        first = bounds["first"]
+        end = bounds["last"] + 1
+        stations = {}
+        for sample in self._get_samples():
+            key = (sample["contract_id"], sample["station_number"])
+            station = stations.get(key)
+            if station is None:
+                station = {
+                    "contract_id": sample["contract_id"],
+                    "station_number": sample["station_number"],
+                    "weighted_bikes": 0,
+                    "empty_seconds": 0,
+                    "full_seconds": 0,
+                    "seconds": 0
+                }
+                stations[key] = station
+            else:
+                self.add_interval(
+                    station,
+                    max(station["timestamp"], first),
+                    min(sample["timestamp"], end))
+            station["timestamp"] = sample["timestamp"]
+            station["bikes"] = sample["available_bikes"]
+            station["slots"] = sample["available_bike_stands"]
+        return self.get_rows(stations.itervalues(), first, end)
+
+    @stage("store occupancy_stations_day")
+    def _store_stations(self, date, stations):
+        if self._arguments.verbose:
+            print "Update table", self.StationsDayTable, "for", date,
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                start_of_day,
+                contract_id,
+                station_number,
+                avg_bikes,
+                empty_seconds,
+                full_seconds,
+                seconds)
+            VALUES(
+                :start_of_day,
+                :contract_id,
+                :station_number,
+                :avg_bikes,
+                :empty_seconds,
+                :full_seconds,
+                :seconds)
+            ''' % self.StationsDayTable,
+            stations,
+            "Database error while storing daily station occupancy into table [%s]" % self.StationsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    @stage("occupancy_contracts")
+    def _do_contracts(self, date):
+        if self._arguments.verbose:
+            print "Update table", self.ContractsDayTable, "for", date,
+        # sum up stations into contracts
+        inserted = self._db.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s
+                SELECT start_of_day,
+                    contract_id,
+                    SUM(avg_bikes),
+                    SUM(empty_seconds),
+                    SUM(full_seconds)
+                FROM %s
+                WHERE start_of_day = strftime('%%s', ?, 'start of day')
+                GROUP BY start_of_day, contract_id
+            ''' % (self.ContractsDayTable, self.StationsDayTable),
+            (date,),
+            "Database error while storing daily contract occupancy into table [%s]" % self.ContractsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    def store_day(self, day):
+        self._store_stations(day["date"], day["occupancy_stations"])
+
+    def run_aggregates(self, date):
+        self._do_contracts(date)
+
+    def run_day(self, date):
+        self._store_stations(date, self.get_stations(date))
+
+    def run(self, date):
+        self.run_day(date)
+        self.run_aggregates(date)
+
+class Quantiles(object):
+
+    StationsDayTable = "quantiles_stations_day"
+    StationsWeekTable = "quantiles_stations_week"
+    StationsMonthTable = "quantiles_stations_month"
+    StationsYearTable = "quantiles_stations_year"
+
+    Percentiles = (("p10", 10), ("p50", 50), ("p90", 90))
+
+    def __init__(self, db, sample_schema, arguments, create_tables=True, samples_by_station=None):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+        assert self._arguments.quantile_width >= 1
+        # station ordered reads may use a sorted copy of the archive
+        self._samples_by_station = samples_by_station
+        if self._samples_by_station is None:
+            self._samples_by_station = "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive)
+        if create_tables:
+            self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        if not self._db.has_table(self.StationsDayTable):
+            self._create_table_stations_custom(self.StationsDayTable, "start_of_day")
+        if not self._db.has_table(self.StationsWeekTable):
+            self._create_table_stations_custom(self.StationsWeekTable, "start_of_week")
+        if not self._db.has_table(self.StationsMonthTable):
+            self._create_table_stations_custom(self.StationsMonthTable, "start_of_month")
+        if not self._db.has_table(self.StationsYearTable):
+            self._create_table_stations_custom(self.StationsYearTable, "start_of_year")
+
+    def _create_table_stations_custom(self, table_name, time_key_name):
+        if self._arguments.verbose:
+            print "Creating table", table_name
+        # sketch is a json list of [bikes, samples] buckets
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                %s INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                sketch TEXT NOT NULL,
+                p10 INTEGER NOT NULL,
+                p50 INTEGER NOT NULL,
+                p90 INTEGER NOT NULL,
+                PRIMARY KEY (%s, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % (table_name, time_key_name, time_key_name),
+            None,
+            "Database error while creating table [%s]" % table_name)
+
+    @staticmethod
+    def get_station_row(time_key_name, time_key, station, buckets):
+        # nearest rank percentiles, accurate to the bucket width
+        ordered = sorted(buckets.iteritems())
+        total = sum(buckets.itervalues())
+        row = {
+            time_key_name: time_key,
+            "contract_id": station[0],
+            "station_number": station[1],
+            "sketch": json.dumps(ordered, separators=(',', ':'))
+        }
+        for name, percentile in Quantiles.Percentiles:
+            rank = max(1, -(-total * percentile // 100))
+            seen = 0
+            for bikes, samples in ordered:
+                seen += samples
+                if seen >= rank:
+                    row[name] = bikes
+                    break
+        return row
+
+    @stage("quantiles_stations")
+    def get_stations_day(self, date):
+        # change log rows stand for runs of identical samples
+        samples = "SUM(samples)" if self._arguments.change_log else "COUNT(timestamp)"
+        rows = self._db.execute_fetch_generator(
+            '''
+            SELECT CAST(%s AS INTEGER) AS start_of_day,
+                contract_id,
+                station_number,
+                available_bikes / :width * :width AS bikes,
+                %s AS samples
+            FROM %s
+            GROUP BY contract_id, station_number, bikes
+            ''' % (Activity.DayStart, samples, self._samples_by_station),
+            {"date": date, "width": self._arguments.quantile_width},
+            "Database error while getting daily stations bikes distribution",
+            True)
+        stations = {}
+        start_of_day = None
+        for row in rows:
+            start_of_day = row["start_of_day"]
+            buckets = stations.setdefault((row["contract_id"], row["station_number"]), {})
+            buckets[row["bikes"]] = row["samples"]
+        return [self.get_station_row("start_of_day", start_of_day, station, buckets)
+                for station, buckets in stations.iteritems()]
+
+    @stage("store {0}")
+    def _store_stations_custom(self, table_name, time_key_name, date, stations):
+        if self._arguments.verbose:
+            print "Update table", table_name, "for", date,
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                %s,
+                contract_id,
+                station_number,
+                sketch,
+                p10,
+                p50,
+                p90)
+            VALUES(
+                :%s,
+                :contract_id,
+                :station_number,
+                :sketch,
+                :p10,
+                :p50,
+                :p90)
+            ''' % (table_name, time_key_name, time_key_name),
+            stations,
+            "Database error while storing station quantiles into table [%s]" % table_name)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    @stage("{0[target_table]}")
+    def _merge_stations_custom(self, params):
+        # sketches of a period are merged by adding their buckets
+        sketches = self._db.execute_fetch_generator(
+            '''
+            SELECT CAST(%s AS INTEGER) AS time_key,
+                contract_id,
+                station_number,
+                sketch
+            FROM %s
+            WHERE %s BETWEEN %s AND %s
+            ''' % (params["time_select"],
+                   params["source_table"],
+                   params["where_select"],
+                   params["between_first"],
+                   params["between_last"]),
+            params,
+            "Database error while getting station quantile sketches",
+            True)
+        width = self._arguments.quantile_width
+        stations = {}
+        time_key = None
+        for sketch in sketches:
+            time_key = sketch["time_key"]
+            buckets = stations.setdefault((sketch["contract_id"], sketch["station_number"]), {})
+            for bikes, samples in json.loads(sketch["sketch"]):
+                bikes = bikes // width * width
+                buckets[bikes] = buckets.get(bikes, 0) + samples
+        rows = [self.get_station_row(params["time_key_name"], time_key, station, buckets)
+                for station, buckets in stations.iteritems()]
+        return self._store_stations_custom(
+            params["target_table"], params["time_key_name"], params["date"], rows)
+
+    def store_day(self, day):
+        self._store_stations_custom(
+            self.StationsDayTable, "start_of_day", day["date"], day["quantiles_stations"])
+
+    def run_day(self, date):
+        self._store_stations_custom(
+            self.StationsDayTable, "start_of_day", date, self.get_stations_day(date))
+
+    def run_week_aggregates(self, date):
+        self._merge_stations_custom({
+            "date": date,
+            "target_table": self.StationsWeekTable,
+            "time_key_name": "start_of_week",
+            "time_select": Activity.WeekStart,
+            "source_table": self.StationsDayTable,
+            "where_select": "start_of_day",
+            "between_first": Activity.WeekStart,
+            "between_last": Activity.WeekEnd
+        })
+
+    def run_month_aggregates(self, date):
+        self._merge_stations_custom({
+            "date": date,
+            "target_table": self.StationsMonthTable,
+            "time_key_name": "start_of_month",
+            "time_select": Activity.MonthStart,
+            "source_table": self.StationsDayTable,
+            "where_select": "start_of_day",
+            "between_first": Activity.MonthStart,
+            "between_last": Activity.MonthEnd
+        })
+
+    def run_year_aggregates(self, date):
+        # yearly station, merged from months
+        self._merge_stations_custom({
+            "date": date,
+            "target_table": self.StationsYearTable,
+            "time_key_name": "start_of_year",
+            "time_select": Activity.YearStart,
+            "source_table": self.StationsMonthTable,
+            "where_select": "start_of_month",
+            "between_first": Activity.YearStart,
+            "between_last": Activity.YearEnd
+        })
+
+    def run_aggregates(self, date):
+        self.run_week_aggregates(date)
+        self.run_month_aggregates(date)
+        self.run_year_aggregates(date)
+
+class SampleScan(object):
+
+    def __init__(self, db, sample_schema, arguments):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+
+    def _get_samples(self, watermarks):
+        # change log rows stand for runs of identical samples
+        samples = "1"
+        if self._arguments.change_log and self._arguments.count == "samples":
+            samples = "samples"
+        # sketches always weight buckets by samples
+        sketch_samples = "1"
+        if self._arguments.change_log:
+            sketch_samples = "samples"
+        # the lowest watermark only bounds contracts having one, contracts
+        # missing from the previous run are read from the start of the file
+        where = "1"
+        params = {}
+        if len(watermarks) > 0:
+            where = "timestamp > :watermark OR contract_id NOT IN (%s)" % ", ".join(
+                "%i" % contract_id for contract_id in sorted(watermarks))
+            params["watermark"] = min(watermarks.itervalues())
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands,
+                %s AS samples,
+                %s AS sketch_samples
+            FROM %s.%s
+            WHERE %s
+            ORDER BY timestamp ASC
+            ''' % (samples,
+                sketch_samples,
+                self._sample_schema,
+                jcd.dao.ShortSamplesDAO.TableNameArchive,
+                where),
+            params,
+            "Database error while getting daily samples",
+            True)
+
+    @stage("scan")
+    def get_day(self, date, stations=None, contracts=None):
+        bounds = get_day_bounds(self._db, date)
+        first = bounds["first"]
+        last = bounds["last"]
+        width = self._arguments.quantile_width
+        # resume from a previous scan state if provided
+        if stations is None:
+            stations = {}
+        if contracts is None:
+            contracts = {}
+        watermarks = dict(
+            (contract_id, contract["last_timestamp"])
+            for contract_id, contract in contracts.iteritems())
+        # single chronological pass over the archive
+        for sample in self._get_samples(watermarks):
+            if sample["timestamp"] <= watermarks.get(sample["contract_id"], -1):
+                continue
+            contract = contracts.get(sample["contract_id"])
+            bikes = sample["available_bikes"]
+            slots = sample["available_bike_stands"]
+            key = (sample["contract_id"], sample["station_number"])
+            station = stations.get(key)
+            if station is None:
+                if contract is None:
+                    # contract total is tracked as an offset from the sum
+                    # of first samples, which is only known at the end
+                    contract = {
+                        "start_of_day": first,
+                        "contract_id": sample["contract_id"],
+                        "first_bikes": 0,
+                        "cur_offset": 0,
+                        "min_offset": 0,
+                        "max_offset": 0,
+                        "last_timestamp": -1
+                    }
+                    contracts[sample["contract_id"]] = contract
+                contract["first_bikes"] += bikes
+                station = {
+                    "start_of_day": first,
+                    "contract_id": sample["contract_id"],
+                    "station_number": sample["station_number"],
+                    "min_bikes": bikes,
+                    "max_bikes": bikes,
+                    "min_slots": slots,
+                    "max_slots": slots,
+                    "num_changes": 0,
+                    "activity": 0,
+                    "bikes": bikes,
+                    "weighted_bikes": 0,
+                    "empty_seconds": 0,
+                    "full_seconds": 0,
+                    "seconds": 0,
+                    "buckets": {}
+                }
+                stations[key] = station
+            else:
+                if contract is None:
+                    contract = contracts[sample["contract_id"]]
+                # occupancy is weighted by the time until this sample
+                Occupancy.add_interval(
+                    station,
+                    max(station["timestamp"], first),
+                    min(sample["timestamp"], last + 1))
+                if bikes < station["min_bikes"]:
+                    station["min_bikes"] = bikes
+                elif bikes > station["max_bikes"]:
+                    station["max_bikes"] = bikes
+                if slots < station["min_slots"]:
+                    station["min_slots"] = slots
+                elif slots > station["max_slots"]:
+                    station["max_slots"] = slots
+                delta = bikes - station["bikes"]
+                if delta != 0:
+                    station["bikes"] = bikes
+                    contract["cur_offset"] += delta
+                    if delta > 0 and contract["cur_offset"] > contract["max_offset"]:
+                        contract["max_offset"] = contract["cur_offset"]
+                    if delta < 0 and contract["cur_offset"] < contract["min_offset"]:
+                        contract["min_offset"] = contract["cur_offset"]
+            station["slots"] = slots
+            station["timestamp"] = sample["timestamp"]
+            bucket = bikes // width * width
+            station["buckets"][bucket] = station["buckets"].get(bucket, 0) + sample["sketch_samples"]
+            station["num_changes"] += sample["samples"]
+            if first <= sample["timestamp"] <= last:
+                station["activity"] += sample["samples"]
+            if sample["timestamp"] > contract["last_timestamp"]:
+                contract["last_timestamp"] = sample["timestamp"]
+        # build the rows expected by the store methods
+        activity = [{
+            "start_of_day": station["start_of_day"],
+            "contract_id": station["contract_id"],
+            "station_number": station["station_number"],
+            "num_changes": station["activity"]
+        } for station in stations.itervalues() if station["activity"] > 0]
+        minmax_contracts = [{
+            "date": date,
+            "contract_id": contract["contract_id"],
+            "min": contract["first_bikes"] + contract["min_offset"],
+            "max": contract["first_bikes"] + contract["max_offset"]
+        } for contract in contracts.itervalues()]
+        return {
+            "date": date,
+            "minmax_stations": stations.values(),
+            "minmax_contracts": minmax_contracts,
+            "activity_stations": activity,
+            "occupancy_stations": Occupancy.get_rows(stations.itervalues(), first, last + 1),
+            "quantiles_stations": [
+                Quantiles.get_station_row("start_of_day", first, key, station["buckets"])
+                for key, station in stations.iteritems()],
+            "scan_contracts": contracts.values()
+        }
+
+class Incremental(object):
+
+    StationsDayTable = "incremental_stations_day"
+    ContractsDayTable = "incremental_contracts_day"
+
+    def __init__(self, db, sample_schema, arguments):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+        self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        if not self._db.has_table(self.StationsDayTable):
+            self._create_stations_day_table()
+        if not self._db.has_table(self.ContractsDayTable):
+            self._create_contracts_day_table()
+
+    def _create_stations_day_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.StationsDayTable
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                start_of_day INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                bikes INTEGER NOT NULL,
+                slots INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                weighted_bikes INTEGER NOT NULL,
+                empty_seconds INTEGER NOT NULL,
+                full_seconds INTEGER NOT NULL,
+                seconds INTEGER NOT NULL,
+                PRIMARY KEY (start_of_day, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % self.StationsDayTable,
+            None,
+            "Database error while creating table [%s]" % self.StationsDayTable)
+
+    def _create_contracts_day_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.ContractsDayTable
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                start_of_day INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                last_timestamp INTEGER NOT NULL,
+                first_bikes INTEGER NOT NULL,
+                cur_offset INTEGER NOT NULL,
+                min_offset INTEGER NOT NULL,
+                max_offset INTEGER NOT NULL,
+                PRIMARY KEY (start_of_day, contract_id)
+            ) WITHOUT ROWID;
+            ''' % self.ContractsDayTable,
+            None,
+            "Database error while creating table [%s]" % self.ContractsDayTable)
+
+    def _get_contracts_state(self, date):
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT start_of_day,
+                contract_id,
+                last_timestamp,
+                first_bikes,
+                cur_offset,
+                min_offset,
+                max_offset
+            FROM %s
+            WHERE start_of_day = strftime('%%s', ?, 'start of day')
+            ''' % self.ContractsDayTable,
+            (date,),
+            "Database error while getting incremental contracts state",
+            True)
+
+    def _get_stations_state(self, date):
+        # stations extremes and counts are resumed from the stats tables
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT s.start_of_day,
+                s.contract_id,
+                s.station_number,
+                m.min_bikes,
+                m.max_bikes,
+                m.min_slots,
+                m.max_slots,
+                m.num_changes,
+                COALESCE(a.num_changes, 0) AS activity,
+                s.bikes,
+                s.slots,
+                s.timestamp,
+                s.weighted_bikes,
+                s.empty_seconds,
+                s.full_seconds,
+                s.seconds,
+                q.sketch
+            FROM %s AS s
+            JOIN %s AS m ON
+                m.start_of_day = s.start_of_day AND
+                m.contract_id = s.contract_id AND
+                m.station_number = s.station_number
+            LEFT JOIN %s AS a ON
+                a.start_of_day = s.start_of_day AND
+                a.contract_id = s.contract_id AND
+                a.station_number = s.station_number
+            LEFT JOIN %s AS q ON
+                q.start_of_day = s.start_of_day AND
+                q.contract_id = s.contract_id AND
+                q.station_number = s.station_number
+            WHERE s.start_of_day = strftime('%%s', ?, 'start of day')
+            ''' % (self.StationsDayTable,
+                   MinMax.StationsDayTable,
+                   Activity.StationsDayTable,
+                   Quantiles.StationsDayTable),
+            (date,),
+            "Database error while getting incremental stations state",
+            True)
+
+    @stage("incremental_read")
+    def read_day(self, date):
+        contracts = {}
+        for contract in self._get_contracts_state(date):
+            contracts[contract["contract_id"]] = contract
+        stations = {}
+        for station in self._get_stations_state(date):
+            # buckets are resumed from the daily sketch
+            station["buckets"] = dict(json.loads(station.pop("sketch") or "[]"))
+            stations[(station["contract_id"], station["station_number"])] = station
+        if self._arguments.verbose:
+            print "Resuming", date, "from", len(contracts), "contracts watermarks"
+        scan = SampleScan(self._db, self._sample_schema, self._arguments)
+        return scan.get_day(date, stations, contracts)
+
+    @stage("store incremental_state")
+    def store_day(self, day):
+        if self._arguments.verbose:
+            print "Update table", self.StationsDayTable, "for", day["date"],
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                start_of_day,
+                contract_id,
+                station_number,
+                bikes,
+                slots,
+                timestamp,
+                weighted_bikes,
+                empty_seconds,
+                full_seconds,
+                seconds)
+            VALUES(
+                :start_of_day,
+                :contract_id,
+                :station_number,
+                :bikes,
+                :slots,
+                :timestamp,
+                :weighted_bikes,
+                :empty_seconds,
+                :full_seconds,
+                :seconds)
+            ''' % self.StationsDayTable,
+            day["minmax_stations"],
+            "Database error while storing incremental stations state into table [%s]" % self.StationsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+            print "Update table", self.ContractsDayTable, "for", day["date"],
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                start_of_day,
+                contract_id,
+                last_timestamp,
+                first_bikes,
+                cur_offset,
+                min_offset,
+                max_offset)
+            VALUES(
+                :start_of_day,
+                :contract_id,
+                :last_timestamp,
+                :first_bikes,
+                :cur_offset,
+                :min_offset,
+                :max_offset)
+            ''' % self.ContractsDayTable,
+            day["scan_contracts"],
+            "Database error while storing incremental contracts state into table [%s]" % self.ContractsDayTable)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+
+    def clear_day(self, date):
+        # a full computation invalidates any previous watermark
+        for table_name in (self.StationsDayTable, self.ContractsDayTable):
+            self._db.execute_single(
+                '''
+                DELETE FROM %s
+                WHERE start_of_day = strftime('%%s', ?, 'start of day')
+                ''' % table_name,
+                (date,),
+                "Database error while clearing incremental state from table [%s]" % table_name)
+
+class SampleIndex(object):
+
+    TempStationsTable = "temp.samples_by_station"
+
+    def __init__(self, db, sample_schema, arguments):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+        self._archive = "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive)
+
+    def _needs_sort(self, order):
+        plan = self._db.execute_fetch_generator(
+            '''
+            EXPLAIN QUERY PLAN
+            SELECT contract_id,
+                station_number,
+                timestamp,
+                available_bikes,
+                available_bike_stands
+            FROM %s
+            ORDER BY %s
+            ''' % (self._archive, order),
+            None,
+            "Database error while inspecting archive indexes",
+            True)
+        return any("TEMP B-TREE" in row["detail"] for row in plan)
+
+    def _create_stations_table(self):
+        self._db.execute_single(
+            '''
+            CREATE TEMP TABLE %s (
+                timestamp INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                available_bikes INTEGER NOT NULL,
+                available_bike_stands INTEGER NOT NULL,
+                PRIMARY KEY (contract_id, station_number, timestamp)
+            ) WITHOUT ROWID;
+            ''' % self.TempStationsTable,
+            None,
+            "Database error while creating table [%s]" % self.TempStationsTable)
+        return self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT timestamp,
+                    contract_id,
+                    station_number,
+                    available_bikes,
+                    available_bike_stands
+                FROM %s
+                ORDER BY contract_id, station_number, timestamp
+            ''' % (self.TempStationsTable, self._archive),
+            None,
+            "Database error while filling table [%s]" % self.TempStationsTable)
+
+    @stage("sample_index")
+    def prepare(self, date):
+        # timestamp ordered reads happen only once per date, so their sort
+        # can not be shared, only report it
+        if self._arguments.verbose and self._needs_sort("timestamp"):
+            print "Archive of", date, "has no timestamp index, chronological reads will sort"
+        # station ordered reads happen several times per date, sort once
+        if self._arguments.sample_index == "off" or not self._needs_sort("contract_id, station_number"):
+            if self._arguments.verbose:
+                print "Archive of", date, "read directly for station ordered queries"
+            return None
+        copied = self._create_stations_table()
+        if self._arguments.verbose:
+            print "Archive of", date, "copied by station into", self.TempStationsTable, "... %i records" % copied
+        return self.TempStationsTable
+
+    def drop(self):
+        self._db.execute_single(
+            "DROP TABLE IF EXISTS %s" % self.TempStationsTable,
+            None,
+            "Database error while dropping table [%s]" % self.TempStationsTable)
+
+class ChangeLog(object):
+
+    # rebuilt for each date, so it is never persisted
+    SamplesDayTable = "temp.changes_samples_day"
+    TempArchiveView = "temp.%s" % jcd.dao.ShortSamplesDAO.TableNameArchive
+
+    def __init__(self, db, sample_schema, arguments):
+        self._db = db
+        self._sample_schema = sample_schema
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._sample_schema is not None
+        assert self._arguments is not None
+        self._archive = "%s.%s" % (self._sample_schema, jcd.dao.ShortSamplesDAO.TableNameArchive)
+        self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        self._db.execute_single(
+            '''
+            CREATE TEMP TABLE IF NOT EXISTS %s (
+                timestamp INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                available_bikes INTEGER NOT NULL,
+                available_bike_stands INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                PRIMARY KEY (timestamp, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % self.SamplesDayTable,
+            None,
+            "Database error while creating table [%s]" % self.SamplesDayTable)
+
+    def _clear(self):
+        self._db.execute_single(
+            "DELETE FROM %s" % self.SamplesDayTable,
+            None,
+            "Database error while clearing table [%s]" % self.SamplesDayTable)
+
+    def _store_day_sql(self, bounds):
+        # a run of identical samples starts at each state change, samples
+        # on both sides of the day boundaries are never in the same run
+        return self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT MIN(timestamp),
+                    contract_id,
+                    station_number,
+                    available_bikes,
+                    available_bike_stands,
+                    COUNT(timestamp)
+                FROM (
+                    SELECT *,
+                        SUM(changed) OVER (
+                            PARTITION BY contract_id, station_number
+                            ORDER BY timestamp) AS run
+                    FROM (
+                        SELECT timestamp,
+                            contract_id,
+                            station_number,
+                            available_bikes,
+                            available_bike_stands,
+                            CASE WHEN
+                                LAG(available_bikes) OVER (
+                                    PARTITION BY contract_id, station_number
+                                    ORDER BY timestamp) = available_bikes AND
+                                LAG(available_bike_stands) OVER (
+                                    PARTITION BY contract_id, station_number
+                                    ORDER BY timestamp) = available_bike_stands AND
+                                LAG(timestamp BETWEEN :first AND :last) OVER (
+                                    PARTITION BY contract_id, station_number
+                                    ORDER BY timestamp) = (timestamp BETWEEN :first AND :last)
+                            THEN 0 ELSE 1 END AS changed
+                        FROM %s
+                    )
+                )
+                GROUP BY contract_id,
+                    station_number,
+                    run,
+                    available_bikes,
+                    available_bike_stands
+            ''' % (self.SamplesDayTable, self._archive),
+            bounds,
+            "Database error while storing change log into table [%s]" % self.SamplesDayTable)
+
+    def _get_runs(self, bounds):
+        samples = self._db.execute_fetch_generator(
+            '''
+            SELECT timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands
+            FROM %s
+            ORDER BY contract_id, station_number, timestamp
+            ''' % self._archive,
+            None,
+            "Database error while getting daily samples",
+            True)
+        run = None
+        for sample in samples:
+            in_day = bounds["first"] <= sample["timestamp"] <= bounds["last"]
+            if (run is not None and
+                    run["contract_id"] == sample["contract_id"] and
+                    run["station_number"] == sample["station_number"] and
+                    run["available_bikes"] == sample["available_bikes"] and
+                    run["available_bike_stands"] == sample["available_bike_stands"] and
+                    run["in_day"] == in_day):
+                run["samples"] += 1
+                continue
+            if run is not None:
+                yield run
+            run = dict(sample)
+            run["in_day"] = in_day
+            run["samples"] = 1
+        if run is not None:
+            yield run
+
+    def _store_day_python(self, bounds):
+        return self._db.execute_many(
+            '''
+            INSERT INTO %s (
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands,
+                samples)
+            VALUES(
+                :timestamp,
+                :contract_id,
+                :station_number,
+                :available_bikes,
+                :available_bike_stands,
+                :samples)
+            ''' % self.SamplesDayTable,
+            self._get_runs(bounds),
+            "Database error while storing change log into table [%s]" % self.SamplesDayTable)
+
+    @stage("change_log")
+    def build(self, date):
+        if self._arguments.verbose:
+            print "Update table", self.SamplesDayTable, "for", date,
+        bounds = get_day_bounds(self._db, date)
+        self._clear()
+        if HasWindowFunctions:
+            inserted = self._store_day_sql(bounds)
+        else:
+            inserted = self._store_day_python(bounds)
+        if self._arguments.verbose:
+            print "... %i records" % inserted
+        return inserted
+
+    def open(self, date):
+        # daily stages read the log through a view named like the archive
+        self._db.execute_single(
+            '''
+            CREATE TEMP VIEW %s AS
+                SELECT timestamp,
+                    contract_id,
+                    station_number,
+                    available_bikes,
+                    available_bike_stands,
+                    samples
+                FROM %s
+            ''' % (jcd.dao.ShortSamplesDAO.TableNameArchive,
+                   self.SamplesDayTable),
+            None,
+            "Database error while creating view [%s]" % self.TempArchiveView)
+        return "temp"
+
+    def close(self):
+        self._db.execute_single(
+            "DROP VIEW IF EXISTS %s" % self.TempArchiveView,
+            None,
+            "Database error while dropping view [%s]" % self.TempArchiveView)
+
+class DirtyAggregates(object):
+
+    AggregatesTable = "dirty_aggregates"
+
+    # rollups depend on the previous level
+    Levels = ("day", "week", "month", "year")
+
+    def __init__(self, db, arguments):
+        self._db = db
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._arguments is not None
+        self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        if not self._db.has_table(self.AggregatesTable):
+            self._create_aggregates_table()
+
+    def _create_aggregates_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.AggregatesTable
+        # date is any processed date of the period
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                level TEXT NOT NULL,
+                period INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                PRIMARY KEY (level, period)
+            ) WITHOUT ROWID;
+            ''' % self.AggregatesTable,
+            None,
+            "Database error while creating table [%s]" % self.AggregatesTable)
+
+    def _get_periods_select(self):
+        return '''
+            SELECT 'day' AS level, CAST(%s AS INTEGER) AS period
+            UNION ALL
+            SELECT 'week', CAST(%s AS INTEGER)
+            UNION ALL
+            SELECT 'month', CAST(%s AS INTEGER)
+            UNION ALL
+            SELECT 'year', CAST(%s AS INTEGER)
+            ''' % (Activity.DayStart, Activity.WeekStart, Activity.MonthStart, Activity.YearStart)
+
+    def mark(self, date):
+        # every aggregate depending on the daily tables of this date
+        return self._db.execute_single(
+            '''
+            INSERT OR IGNORE INTO %s (
+                level,
+                period,
+                date)
+            SELECT level,
+                period,
+                :date
+            FROM (%s)
+            ''' % (self.AggregatesTable, self._get_periods_select()),
+            {"date": date},
+            "Database error while marking aggregates of %s dirty" % date)
+
+    def clear(self, level, period):
+        self._db.execute_single(
+            '''
+            DELETE FROM %s
+            WHERE level = ? AND
+                period = ?
+            ''' % self.AggregatesTable,
+            (level, period),
+            "Database error while clearing dirty aggregates")
+
+    def clear_date(self, date):
+        self._db.execute_single(
+            '''
+            DELETE FROM %s
+            WHERE (level, period) IN (%s)
+            ''' % (self.AggregatesTable, self._get_periods_select()),
+            {"date": date},
+            "Database error while clearing dirty aggregates of %s" % date)
+
+    def get_pending(self, level):
+        return self._db.execute_fetch_generator(
+            '''
+            SELECT level,
+                period,
+                strftime('%%Y-%%m-%%d', period, 'unixepoch') AS start,
+                date
+            FROM %s
+            WHERE level = ?
+            ORDER BY period
+            ''' % self.AggregatesTable,
+            (level,),
+            "Database error while getting dirty aggregates",
+            True)
+
+    def report(self):
+        pending = 0
+        for level in self.Levels:
+            for mark in self.get_pending(level):
+                print "%-5s %s (from %s)" % (mark["level"], mark["start"], mark["date"])
+                pending += 1
+        if pending == 0:
+            print "No pending aggregates"
+        return pending
+
+class Prefetcher(object):
+
+    BlockSize = 1048576
+
+    def __init__(self, arguments):
+        self._arguments = arguments
+        assert self._arguments is not None
+        self._thread = None
+        self._result = None
+
+    def _get_path(self, date):
+        schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+        return os.path.join(os.path.expanduser(self._arguments.datadir), filename)
+
+    def _read(self, date):
+        # reads go through a single block, only the os page cache keeps
+        # the file, and file reads release the gil for the main thread
+        begin = time.time()
+        block = bytearray(self.BlockSize)
+        size = 0
+        try:
+            with io.open(self._get_path(date), "rb", buffering=0) as samples:
+                while True:
+                    read = samples.readinto(block)
+                    if not read:
+                        break
+                    size += read
+        except IOError:
+            pass
+        self._result = (date, size, time.time() - begin)
+
+    def wait(self):
+        if self._thread is None:
+            return
+        self._thread.join()
+        self._thread = None
+        if self._arguments.verbose:
+            print "Prefetched %s, %i bytes in %.3f s" % self._result
+
+    def start(self, date):
+        # at most one date is read ahead
+        self.wait()
+        self._thread = threading.Thread(target=self._read, args=(date,))
+        self._thread.daemon = True
+        self._thread.start()
+
+class CompactLayout(object):
+
+    KeysTable = "stations_keys"
+    FactsSuffix = "_facts"
+
+    # station tables keyed on (time, contract_id, station_number)
+    StationsTables = (
+        MinMax.StationsDayTable,
+        MinMax.StationsWeekTable,
+        MinMax.StationsMonthTable,
+        MinMax.StationsYearTable,
+        Activity.StationsDayTable,
+        Activity.StationsWeekTable,
+        Activity.StationsMonthTable,
+        Activity.StationsYearTable,
+        Activity.Stations7DaysTable,
+        Activity.Stations30DaysTable
+    )
+
+    def __init__(self, db, arguments):
+        self._db = db
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._arguments is not None
+
+    def _create_keys_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.KeysTable
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                station_key INTEGER PRIMARY KEY,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                UNIQUE (contract_id, station_number)
+            );
+            ''' % self.KeysTable,
+            None,
+            "Database error while creating table [%s]" % self.KeysTable)
+
+    def _get_table_type(self, table_name):
+        types = self._db.execute_fetch_generator(
+            "SELECT type FROM sqlite_master WHERE name = ?",
+            (table_name,),
+            "Database error while inspecting [%s]" % table_name,
+            True)
+        return next(types, {"type": None})["type"]
+
+    def _get_columns(self, table_name):
+        return list(self._db.execute_fetch_generator(
+            "PRAGMA table_info(%s)" % table_name,
+            None,
+            "Database error while inspecting [%s]" % table_name,
+            True))
+
+    def _get_key_select(self, row):
+        return '''
+            SELECT station_key
+            FROM %s
+            WHERE contract_id = %s.contract_id AND
+                station_number = %s.station_number
+            ''' % (self.KeysTable, row, row)
+
+    def _create_facts_table(self, facts_table, time_key_name, values):
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                %s INTEGER NOT NULL,
+                station_key INTEGER NOT NULL,
+                %s,
+                PRIMARY KEY (%s, station_key)
+            ) WITHOUT ROWID;
+            ''' % (facts_table,
+                   time_key_name,
+                   ",\n                ".join(
+                       "%s %s%s" % (column["name"], column["type"], " NOT NULL" if column["notnull"] else "")
+                       for column in values),
+                   time_key_name),
+            None,
+            "Database error while creating table [%s]" % facts_table)
+        if "rank_global" not in [column["name"] for column in values]:
+            return
+        # rank indexes of the wide table, contracts are only known by keys
+        for index_name, columns in (
+                (facts_table + "_rank_global", (time_key_name, "rank_global")),
+                (facts_table + "_station", ("station_key", time_key_name))):
+            self._db.execute_single(
+                "CREATE INDEX %s ON %s (%s)" % (index_name, facts_table, ", ".join(columns)),
+                None,
+                "Database error while creating index [%s]" % index_name)
+
+    def _create_view(self, table_name, facts_table, time_key_name, values):
+        # present the wide layout, so that stages and readers are unchanged
+        self._db.execute_single(
+            '''
+            CREATE VIEW %s AS
+                SELECT f.%s,
+                    k.contract_id,
+                    k.station_number,
+                    %s
+                FROM %s AS f
+                JOIN %s AS k ON
+                    k.station_key = f.station_key
+            ''' % (table_name,
+                   time_key_name,
+                   ",\n                    ".join("f.%s" % column["name"] for column in values),
+                   facts_table,
+                   self.KeysTable),
+            None,
+            "Database error while creating view [%s]" % table_name)
+        # the conflict clause of writes to the view applies to the facts,
+        # keys are only added when missing so that they never conflict
+        self._db.execute_single(
+            '''
+            CREATE TRIGGER %s_insert INSTEAD OF INSERT ON %s
+            BEGIN
+                INSERT INTO %s (contract_id, station_number)
+                    SELECT NEW.contract_id,
+                        NEW.station_number
+                    WHERE NOT EXISTS (%s);
+                INSERT INTO %s
+                    VALUES (NEW.%s, (%s), %s);
+            END
+            ''' % (table_name, table_name,
+                   self.KeysTable, self._get_key_select("NEW"),
+                   facts_table, time_key_name, self._get_key_select("NEW"),
+                   ", ".join("NEW.%s" % column["name"] for column in values)),
+            None,
+            "Database error while creating insert trigger of [%s]" % table_name)
+        self._db.execute_single(
+            '''
+            CREATE TRIGGER %s_delete INSTEAD OF DELETE ON %s
+            BEGIN
+                DELETE FROM %s
+                WHERE %s = OLD.%s AND
+                    station_key = (%s);
+            END
+            ''' % (table_name, table_name,
+                   facts_table, time_key_name, time_key_name, self._get_key_select("OLD")),
+            None,
+            "Database error while creating delete trigger of [%s]" % table_name)
+        self._db.execute_single(
+            '''
+            CREATE TRIGGER %s_update INSTEAD OF UPDATE ON %s
+            BEGIN
+                INSERT INTO %s (contract_id, station_number)
+                    SELECT NEW.contract_id,
+                        NEW.station_number
+                    WHERE NOT EXISTS (%s);
+                UPDATE %s
+                SET %s = NEW.%s,
+                    station_key = (%s),
+                    %s
+                WHERE %s = OLD.%s AND
+                    station_key = (%s);
+            END
+            ''' % (table_name, table_name,
+                   self.KeysTable, self._get_key_select("NEW"),
+                   facts_table, time_key_name, time_key_name, self._get_key_select("NEW"),
+                   ",\n                    ".join("%s = NEW.%s" % (column["name"], column["name"]) for column in values),
+                   time_key_name, time_key_name, self._get_key_select("OLD")),
+            None,
+            "Database error while creating update trigger of [%s]" % table_name)
+
+    def _migrate_table(self, table_name):
+        if self._get_table_type(table_name) != "table":
+            return 0
+        if self._arguments.verbose:
+            print "Converting table", table_name,
+        columns = self._get_columns(table_name)
+        time_key_name = columns[0]["name"]
+        values = columns[3:]
+        facts_table = table_name + self.FactsSuffix
+        self._db.execute_single(
+            '''
+            INSERT INTO %s (contract_id, station_number)
+                SELECT DISTINCT contract_id,
+                    station_number
+                FROM %s AS t
+                WHERE NOT EXISTS (%s)
+            ''' % (self.KeysTable, table_name, self._get_key_select("t")),
+            None,
+            "Database error while storing station keys from [%s]" % table_name)
+        self._create_facts_table(facts_table, time_key_name, values)
+        converted = self._db.execute_single(
+            '''
+            INSERT INTO %s
+                SELECT t.%s,
+                    k.station_key,
+                    %s
+                FROM %s AS t
+                JOIN %s AS k ON
+                    k.contract_id = t.contract_id AND
+                    k.station_number = t.station_number
+            ''' % (facts_table,
+                   time_key_name,
+                   ", ".join("t.%s" % column["name"] for column in values),
+                   table_name,
+                   self.KeysTable),
+            None,
+            "Database error while converting [%s]" % table_name)
+        self._db.execute_single(
+            "DROP TABLE %s" % table_name,
+            None,
+            "Database error while dropping table [%s]" % table_name)
+        self._create_view(table_name, facts_table, time_key_name, values)
+        if self._arguments.verbose:
+            print "... %i records" % converted
+        return converted
+
+    def migrate(self):
+        # missing tables are created wide first, then converted like others
+        MinMax(self._db, "main", self._arguments)
+        Activity(self._db, "main", self._arguments)
+        if self._get_table_type(self.KeysTable) is None:
+            self._create_keys_table()
+        converted = 0
+        # tables are converted all at once or not at all
+        with Transaction(self._db):
+            for table_name in self.StationsTables:
+                converted += self._migrate_table(table_name)
+        return converted
+
+class CompactWrites(object):
+
+    # table written by an insert, update or delete statement
+    WrittenTable = re.compile(
+        r"^\s*(?:(?:INSERT|REPLACE|UPDATE)(?:\s+OR\s+\w+)?(?:\s+INTO)?|DELETE\s+FROM)\s+(?:main\.)?(\w+)",
+        re.IGNORECASE)
+
+    def __init__(self, db):
+        self._db = db
+        assert self._db is not None
+
+    def __getattr__(self, name):
+        # anything not written goes straight to the db
+        return getattr(self._db, name)
+
+    def _get_written(self):
+        # rows written by the triggers of compact views are only counted in
+        # total changes, along with the station keys they added
+        changes = self._db.execute_fetch_generator(
+            '''
+            SELECT total_changes() - (
+                SELECT COALESCE(MAX(station_key), 0)
+                FROM %s) AS written
+            ''' % CompactLayout.KeysTable,
+            None,
+            "Database error while counting written rows",
+            True)
+        return next(changes)["written"]
+
+    def _is_compact_write(self, sql):
+        # other statements report their rows themselves
+        match = self.WrittenTable.match(sql)
+        return match is not None and match.group(1) in CompactLayout.StationsTables
+
+    def execute_single(self, sql, params, error_message):
+        if not self._is_compact_write(sql):
+            return self._db.execute_single(sql, params, error_message)
+        before = self._get_written()
+        written = self._db.execute_single(sql, params, error_message)
+        if written < 0:
+            return written
+        return self._get_written() - before
+
+    def execute_many(self, sql, iterable, error_message):
+        if not self._is_compact_write(sql):
+            return self._db.execute_many(sql, iterable, error_message)
+        before = self._get_written()
+        written = self._db.execute_many(sql, iterable, error_message)
+        if written < 0:
+            return written
+        return self._get_written() - before
+
+class Partitions(object):
+
+    # every persistent MinMax and Activity table is partitioned by year
+    PartitionedTables = tuple(
+        sorted(value for name, value in vars(MinMax).items()
+               if name.endswith("Table")) +
+        sorted(value for name, value in vars(Activity).items()
+               if name.endswith("Table") and not name.startswith("Temp")))
+    # weeks are stored with the year they start in
+    WeekTables = (
+        MinMax.StationsWeekTable, MinMax.ContractsWeekTable, MinMax.GlobalsWeekTable,
+        Activity.StationsWeekTable, Activity.ContractsWeekTable, Activity.GlobalWeekTable)
+
+    def __init__(self, db, arguments, migrate_tables=True):
+        self._db = db
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._arguments is not None
+        self._years = ()
+        if migrate_tables and self._arguments.partition == "year":
+            self._migrate_if_necessary()
+
+    @staticmethod
+    def get_schema(year):
+        return "stats_%i" % year
+
+    @staticmethod
+    def _get_year_start(year):
+        return int((datetime.datetime(year, 1, 1) - datetime.datetime(1970, 1, 1)).total_seconds())
+
+    def _get_filename(self, year):
+        base, extension = os.path.splitext(self._arguments.statdbname)
+        return "%s_%i%s" % (base, year, extension)
+
+    def _get_path(self, year):
+        return os.path.join(os.path.expanduser(self._arguments.datadir), self._get_filename(year))
+
+    def _create_partition(self, year):
+        # tables are created by their own classes in the partition file
+        with jcd.common.SqliteDB(self._get_filename(year), self._arguments.datadir) as db:
+            db = TableCache(db)
+            MinMax(db, "main", self._arguments)
+            Activity(db, "main", self._arguments)
+
+    def _get_columns(self, schema, table_name):
+        return list(self._db.execute_fetch_generator(
+            "PRAGMA %s.table_info(%s)" % (schema, table_name),
+            None,
+            "Database error while inspecting [%s.%s]" % (schema, table_name),
+            True))
+
+    def _get_main_tables(self):
+        tables = self._db.execute_fetch_generator(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table'",
+            None,
+            "Database error while listing tables",
+            True)
+        return set(table["name"] for table in tables) & set(self.PartitionedTables)
+
+    def _get_table_years(self, table_name, time_key_name):
+        years = self._db.execute_fetch_generator(
+            '''
+            SELECT DISTINCT CAST(strftime('%%Y', %s, 'unixepoch') AS INTEGER) AS year
+            FROM main.%s
+            ''' % (time_key_name, table_name),
+            None,
+            "Database error while listing years of [%s]" % table_name,
+            True)
+        return [row["year"] for row in years]
+
+    def _migrate_if_necessary(self):
+        # rows of a single file stats db are moved to their year partition
+        tables = []
+        for table_name in sorted(self._get_main_tables()):
+            time_key_name = self._get_columns("main", table_name)[0]["name"]
+            tables.append((table_name, time_key_name, self._get_table_years(table_name, time_key_name)))
+        if len(tables) == 0:
+            return
+        years = sorted(set(year for _, _, table_years in tables for year in table_years))
+        for year in years:
+            self._create_partition(year)
+            self._db.attach_database(self._get_filename(year), self.get_schema(year), self._arguments.datadir)
+        try:
+            # rows are moved and tables dropped all at once or not at all,
+            # across every attached partition
+            with Transaction(self._db):
+                for table_name, time_key_name, table_years in tables:
+                    for year in table_years:
+                        if self._arguments.verbose:
+                            print "Moving", year, "rows of", table_name, "to", self._get_filename(year),
+                        moved = self._db.execute_single(
+                            '''
+                            INSERT OR REPLACE INTO %s.%s
+                                SELECT *
+                                FROM main.%s
+                                WHERE %s >= ? AND %s < ?
+                            ''' % (self.get_schema(year), table_name, table_name, time_key_name, time_key_name),
+                            (self._get_year_start(year), self._get_year_start(year + 1)),
+                            "Database error while moving rows of [%s]" % table_name)
+                        if self._arguments.verbose:
+                            print "... %i records" % moved
+                    self._db.execute_single(
+                        "DROP TABLE main.%s" % table_name,
+                        None,
+                        "Database error while dropping table [%s]" % table_name)
+        finally:
+            for year in years:
+                self._db.detach_database(self.get_schema(year))
+
+    def _create_view(self, table_name):
+        # reads see every attached year, writes name the year of their key
+        self._db.execute_single(
+            "CREATE TEMP VIEW %s AS %s" % (
+                table_name,
+                " UNION ALL ".join(
+                    "SELECT * FROM %s.%s" % (self.get_schema(year), table_name)
+                    for year in self._years)),
+            None,
+            "Database error while creating view [%s]" % table_name)
+
+    def get_years(self):
+        # years having a partition file next to the stats db
+        base, extension = os.path.splitext(self._arguments.statdbname)
+        pattern = re.compile(r"^%s_(\d{4})%s$" % (re.escape(base), re.escape(extension)))
+        years = []
+        for filename in os.listdir(os.path.expanduser(self._arguments.datadir)):
+            match = pattern.match(filename)
+            if match is not None:
+                years.append(int(match.group(1)))
+        return sorted(years)
+
+    def open(self, years):
+        # attaches the partitions of these years that exist, and creates
+        # temp views named like the tables over them; temp views only live
+        # on this connection, so readers of a partitioned stats db, such as
+        # jcdquery, call it on their own connection:
+        #     partitions = Partitions(db, arguments, False)
+        #     partitions.open(partitions.get_years())
+        # at most 10 dbs can be attached with default sqlite builds
+        years = tuple(year for year in sorted(set(years))
+                      if os.path.exists(self._get_path(year)))
+        if years == self._years:
+            return
+        self.close()
+        for year in years:
+            if self._arguments.verbose:
+                print "Attaching stats partition", self._get_filename(year)
+            self._db.attach_database(self._get_filename(year), self.get_schema(year), self._arguments.datadir)
+        self._years = years
+        if len(self._years) == 0:
+            return
+        for table_name in self.PartitionedTables:
+            self._create_view(table_name)
+
+    def close(self):
+        if len(self._years) == 0:
+            return
+        for table_name in self.PartitionedTables:
+            self._db.execute_single(
+                "DROP VIEW IF EXISTS temp.%s" % table_name,
+                None,
+                "Database error while dropping view [%s]" % table_name)
+        for year in self._years:
+            self._db.detach_database(self.get_schema(year))
+        self._years = ()
+
+    def route(self, date):
+        if self._arguments.partition != "year":
+            return
+        # weeks and trailing windows may reach the previous year, and
+        # processing a date again may refresh windows of the next one
+        day = datetime.datetime.strptime(date, "%Y-%m-%d")
+        window = datetime.timedelta(days=max(days for days, _, _ in Activity.TrailingTables))
+        first = (day - window).year
+        last = (day + window).year
+        for year in xrange(first, day.year + 1):
+            if not os.path.exists(self._get_path(year)):
+                self._create_partition(year)
+        # called between transactions, files can be detached
+        self.open(xrange(first, last + 1))
+
+class Manifest(object):
+
+    SamplesDayTable = "manifest_samples_day"
+
+    def __init__(self, db, arguments):
+        self._db = db
+        self._arguments = arguments
+        assert self._db is not None
+        assert self._arguments is not None
+        self._create_tables_if_necessary()
+
+    def _create_tables_if_necessary(self):
+        if not self._db.has_table(self.SamplesDayTable):
+            self._create_samples_day_table()
+
+    def _create_samples_day_table(self):
+        if self._arguments.verbose:
+            print "Creating table", self.SamplesDayTable
+        self._db.execute_single(
+            '''
+            CREATE TABLE %s (
+                date TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                file_mtime REAL NOT NULL,
+                PRIMARY KEY (date)
+            ) WITHOUT ROWID;
+            ''' % self.SamplesDayTable,
+            None,
+            "Database error while creating table [%s]" % self.SamplesDayTable)
+
+    def get_file_state(self, date):
+        schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+        try:
+            stat = os.stat(os.path.join(os.path.expanduser(self._arguments.datadir), filename))
+        except OSError:
+            return None
+        return {
             "date": date,
-            "target_table": self.GlobalYearTable,
-            "time_select": "start_of_year",
-            "source_table": self.ContractsYearTable,
-            "where_clause": "start_of_year = strftime('%s', :date, 'start of year')",
-        })
+            "file_size": stat.st_size,
+            "file_mtime": stat.st_mtime
+        }
+
+    def is_unchanged(self, state):
+        matches = self._db.execute_fetch_generator(
+            '''
+            SELECT COUNT(*) AS matches
+            FROM %s
+            WHERE date = :date AND
+                file_size = :file_size AND
+                file_mtime = :file_mtime
+            ''' % self.SamplesDayTable,
+            state,
+            "Database error while reading manifest",
+            True)
+        return next(matches)["matches"] > 0
+
+    def store(self, states):
+        inserted = self._db.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                date,
+                file_size,
+                file_mtime)
+            VALUES(
+                :date,
+                :file_size,
+                :file_mtime)
+            ''' % self.SamplesDayTable,
+            states,
+            "Database error while storing manifest into table [%s]" % self.SamplesDayTable)
+        if self._arguments.verbose:
+            print "Manifest updated for %i dates" % inserted
+        return inserted
+
+def read_day(db, sample_schema, arguments, date, samples_by_station=None):
+    if arguments.engine == "scan":
+        return SampleScan(db, sample_schema, arguments).get_day(date)
+    occupancy = Occupancy(db, sample_schema, arguments, False)
+    quantiles = Quantiles(db, sample_schema, arguments, False, samples_by_station)
+    minmax = MinMax(db, sample_schema, arguments, False, samples_by_station)
+    activity = Activity(db, sample_schema, arguments, False, samples_by_station)
+    return {
+        "date": date,
+        "minmax_stations": list(minmax.get_stations(date)),
+        "minmax_contracts": minmax.get_contracts(date),
+        "activity_stations": list(activity.get_stations_day(date)),
+        "occupancy_stations": occupancy.get_stations(date),
+        "quantiles_stations": quantiles.get_stations_day(date)
+    }
+
+def get_contract_ranges(arguments, date):
+    # shards are ranges of contract ids, which an index on contract_id can
+    # serve, holding about the same number of contracts
+    schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+    filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+    with jcd.common.SqliteDB(filename, arguments.datadir) as db_samples:
+        contracts = [row["contract_id"] for row in db_samples.execute_fetch_generator(
+            '''
+            SELECT DISTINCT contract_id
+            FROM main.%s
+            ORDER BY contract_id
+            ''' % jcd.dao.ShortSamplesDAO.TableNameArchive,
+            None,
+            "Database error while listing contracts of [%s]" % filename,
+            True)]
+    if len(contracts) == 0:
+        return [None]
+    count = min(arguments.shards, len(contracts))
+    return [(contracts[len(contracts) * shard // count],
+             contracts[len(contracts) * (shard + 1) // count - 1])
+            for shard in xrange(count)]
+
+def extract_day(job):
+    # runs in a worker process, only reads the daily sample db
+    arguments, date, shard = job
+    schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+    filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+    with jcd.common.SqliteDB(filename, arguments.datadir) as db_samples:
+        if arguments.metrics is None:
+            return read_sample_day(db_samples, arguments, date, shard)
+        # worker stages are sent back with the day
+        db_samples = Instrumentation(db_samples, arguments)
+        db_samples.begin_stage("extract_day", (date,))
+        try:
+            day = read_sample_day(db_samples, arguments, date, shard)
+        finally:
+            db_samples.end_stage()
+        day["metrics"] = db_samples.get_stages()
+        return day
+
+def read_sample_day(db_samples, arguments, date, shard):
+    db_samples.execute_single(
+        "PRAGMA mmap_size = %i" % get_profile_pragma(arguments.profile, "mmap_size"),
+        None,
+        "Database error while setting mmap size")
+    sample_schema = "main"
+    if shard is not None:
+        # contracts never interact, so each shard only sees its own
+        db_samples.execute_single(
+            '''
+            CREATE TEMP VIEW %s AS
+                SELECT *
+                FROM main.%s
+                WHERE contract_id BETWEEN %i AND %i
+            ''' % (jcd.dao.ShortSamplesDAO.TableNameArchive,
+                   jcd.dao.ShortSamplesDAO.TableNameArchive,
+                   shard[0],
+                   shard[1]),
+            None,
+            "Database error while creating shard view")
+        sample_schema = "temp"
+    samples_by_station = None
+    if arguments.engine != "scan":
+        samples_by_station = SampleIndex(db_samples, sample_schema, arguments).prepare(date)
+    db_samples.execute_single(
+        "PRAGMA query_only = 1",
+        None,
+        "Database error while setting query only")
+    return read_day(db_samples, sample_schema, arguments, date, samples_by_station)
+
+def merge_days(days):
+    merged = {"date": days[0]["date"]}
+    for day in days:
+        for key, rows in day.iteritems():
+            if key != "date":
+                merged.setdefault(key, []).extend(rows)
+    return merged
 
 class App(object):
 
@@ -697,31 +3742,510 @@ class App(object):
             action='store_true',
             help='display operationnal informations'
         )
+        self._parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            help='number of worker processes for daily stages (default: 1)'
+        )
+        self._parser.add_argument(
+            '--shards',
+            type=int,
+            default=1,
+            help='split the contracts of each date across this number of worker jobs (default: 1)'
+        )
+        self._parser.add_argument(
+            '--engine',
+            choices=['sql', 'scan', 'numpy'],
+            default='sql',
+            help='daily stages engine, scan reads samples only once, numpy vectorizes contracts when available (default: sql)'
+        )
+        self._parser.add_argument(
+            '--sample-index',
+            choices=['auto', 'off'],
+            default='auto',
+            help='copy the archive sorted by station when its indexes do not serve grouped queries (default: auto)'
+        )
+        self._parser.add_argument(
+            '--rollup',
+            choices=['full', 'delta'],
+            default='full',
+            help='rebuild weeks, months and years, or only apply daily changes to them (default: full)'
+        )
+        self._parser.add_argument(
+            '--prefetch',
+            action='store_true',
+            help='read the next sample db from disk in background while computing the current date'
+        )
+        self._parser.add_argument(
+            '--change-log',
+            action='store_true',
+            help='keep a log of the samples changing a station for each date, and read daily stages from it'
+        )
+        self._parser.add_argument(
+            '--count',
+            choices=['samples', 'changes'],
+            default='samples',
+            help='what num_changes counts with --change-log, every sample or only state changes (default: samples)'
+        )
+        self._parser.add_argument(
+            '--quantile-width',
+            type=int,
+            default=1,
+            help='bikes per bucket of the quantile sketches, larger buckets are smaller and less accurate (default: 1)'
+        )
+        self._parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='only process samples newer than the previous run for each date'
+        )
+        self._parser.add_argument(
+            '--profile',
+            choices=sorted(SqliteProfiles),
+            default='safe',
+            help='sqlite performance profile of the stats db, backfill is faster but not crash safe (default: safe)'
+        )
+        self._parser.add_argument(
+            '--metrics',
+            metavar='FILE',
+            help='write per stage duration and row counts to this file'
+        )
+        self._parser.add_argument(
+            '--metrics-format',
+            choices=['jsonl', 'prometheus'],
+            default='jsonl',
+            help='json lines appended per run, or prometheus textfile (default: jsonl)'
+        )
+        self._parser.add_argument(
+            '--metrics-plans',
+            action='store_true',
+            help='add the query plan of every stage query to json metrics'
+        )
+        self._parser.add_argument(
+            '--force',
+            action='store_true',
+            help='process dates even if their sample db did not change since last run'
+        )
+        self._parser.add_argument(
+            '--from',
+            dest='date_from',
+            metavar='DATE',
+            help='first date of a range to build stats for (YYYY-MM-DD)'
+        )
+        self._parser.add_argument(
+            '--to',
+            dest='date_to',
+            metavar='DATE',
+            help='last date of a range to build stats for (YYYY-MM-DD)'
+        )
+        self._parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='keep running, and process daily sample dbs of the data folder as they appear or grow'
+        )
+        self._parser.add_argument(
+            '--watch-interval',
+            type=int,
+            default=60,
+            metavar='SECONDS',
+            help='seconds between two checks of the data folder in watch mode (default: 60)'
+        )
+        self._parser.add_argument(
+            '--migrate-compact',
+            action='store_true',
+            help='convert station tables to the compact layout keyed on station keys, and exit'
+        )
+        self._parser.add_argument(
+            '--list-dirty',
+            action='store_true',
+            help='list aggregates waiting to be recomputed after their days changed, and exit'
+        )
+        self._parser.add_argument(
+            '--aggregate-dirty',
+            action='store_true',
+            help='recompute aggregates waiting after their days changed, and exit'
+        )
+        self._parser.add_argument(
+            '--partition',
+            choices=['none', 'year'],
+            default='none',
+            help='store min-max and activity stats in one db per year next to the stats db, attached when needed (default: none)'
+        )
         self._parser.add_argument(
             'date',
             metavar='date',
             type=str,
-            nargs='+',
+            nargs='*',
             help='a date for which to build stats')
 
+    @staticmethod
+    def _clear_incremental(db_stats, schema, arguments, date):
+        # full computations invalidate watermarks left by incremental runs
+        if db_stats.has_table(Incremental.ContractsDayTable):
+            Incremental(db_stats, schema, arguments).clear_day(date)
+
+    @staticmethod
+    def _is_closed_day(date):
+        # whatever the timezone used by the collector, the day is over
+        try:
+            day = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+            return False
+        return day < min(datetime.date.today(), datetime.datetime.utcnow().date())
+
+    @staticmethod
+    def _is_immutable(arguments, date, path):
+        # watched dbs are processed because they just changed
+        if arguments.watch or not App._is_closed_day(date):
+            return False
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime > ImmutableGracePeriod
+
+    @staticmethod
+    def _attach_samples(db_stats, arguments, date):
+        schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+        path = os.path.abspath(os.path.join(os.path.expanduser(arguments.datadir), filename))
+        if not HasUriFilenames or not App._is_immutable(arguments, date, path):
+            db_stats.attach_database(filename, schema, arguments.datadir)
+            return schema
+        # closed days will not change anymore, so sqlite can skip locking
+        # and change detection, and read them through memory mapping
+        if arguments.verbose:
+            print "Attaching", path, "as immutable"
+        db_stats.execute_single(
+            "ATTACH DATABASE ? AS %s" % schema,
+            ("file:%s?mode=ro&immutable=1" % urllib.quote(path),),
+            "Database error while attaching [%s]" % path)
+        db_stats.execute_single(
+            "PRAGMA %s.mmap_size = %i" % (schema, get_profile_pragma(arguments.profile, "mmap_size")),
+            None,
+            "Database error while setting mmap size of [%s]" % schema)
+        return schema
+
+    @staticmethod
+    def _run_serial(db_stats, arguments, planned, partitions):
+        prefetcher = None
+        if arguments.prefetch:
+            prefetcher = Prefetcher(arguments)
+        for index, date in enumerate(arguments.date):
+            # next sample db is read from disk while this one is computed
+            if prefetcher is not None:
+                prefetcher.wait()
+                if index + 1 < len(arguments.date):
+                    prefetcher.start(arguments.date[index + 1])
+            if arguments.verbose:
+                print "Processing", date
+            # attach db
+            partitions.route(date)
+            schema = App._attach_samples(db_stats, arguments, date)
+            sample_schema = schema
+            changes = None
+            sample_index = None
+            try:
+                if arguments.change_log:
+                    changes = ChangeLog(db_stats, schema, arguments)
+                    changes.build(date)
+                    sample_schema = changes.open(date)
+                # station ordered reads only happen in sql and numpy engines,
+                # the change log is small enough to be read as is
+                samples_by_station = None
+                if arguments.engine != "scan" and not arguments.incremental and changes is None:
+                    sample_index = SampleIndex(db_stats, schema, arguments)
+                    samples_by_station = sample_index.prepare(date)
+                # do processing, tables are created before the transaction
+                minmax = MinMax(db_stats, sample_schema, arguments, True, samples_by_station)
+                activity = Activity(db_stats, sample_schema, arguments, True, samples_by_station)
+                occupancy = Occupancy(db_stats, sample_schema, arguments)
+                quantiles = Quantiles(db_stats, sample_schema, arguments, True, samples_by_station)
+                dirty = DirtyAggregates(db_stats, arguments)
+                incremental = None
+                if arguments.incremental:
+                    incremental = Incremental(db_stats, schema, arguments)
+                # every stage of a date is a single transaction
+                with Transaction(db_stats):
+                    if incremental is not None:
+                        day = incremental.read_day(date)
+                        minmax.store_day(day)
+                        activity.store_day(day)
+                        occupancy.store_day(day)
+                        quantiles.store_day(day)
+                        incremental.store_day(day)
+                    elif arguments.engine != "scan":
+                        App._clear_incremental(db_stats, schema, arguments, date)
+                        minmax.run_day(date)
+                        activity.run_day(date)
+                        occupancy.run_day(date)
+                        quantiles.run_day(date)
+                    else:
+                        App._clear_incremental(db_stats, schema, arguments, date)
+                        day = read_day(db_stats, sample_schema, arguments, date)
+                        minmax.store_day(day)
+                        activity.store_day(day)
+                        occupancy.store_day(day)
+                        quantiles.store_day(day)
+                    dirty.mark(date)
+                    if not planned:
+                        minmax.run_aggregates(date)
+                        activity.run_aggregates(date)
+                        occupancy.run_aggregates(date)
+                        quantiles.run_aggregates(date)
+                        dirty.clear_date(date)
+            finally:
+                # nothing is left attached by a failed date
+                if sample_index is not None:
+                    sample_index.drop()
+                if changes is not None:
+                    changes.close()
+                # detach db
+                db_stats.detach_database(schema)
+        if prefetcher is not None:
+            prefetcher.wait()
+
+    @staticmethod
+    def _get_jobs(arguments, counts):
+        # consumed by the pool while workers run, so that contracts of a
+        # date are listed while previous dates are computed
+        for date in arguments.date:
+            shards = [None]
+            if arguments.shards > 1:
+                shards = get_contract_ranges(arguments, date)
+            # known before any shard of the date can be returned
+            counts[date] = len(shards)
+            for shard in shards:
+                yield (arguments, date, shard)
+
+    @staticmethod
+    def _run_parallel(db_stats, arguments, partitions):
+        # daily stages are computed by workers, and stored by this process only
+        pool = multiprocessing.Pool(arguments.jobs)
+        try:
+            counts = {}
+            shards = {}
+            for shard_day in pool.imap_unordered(extract_day, App._get_jobs(arguments, counts)):
+                # a date is stored once all its contract shards are merged
+                shards.setdefault(shard_day["date"], []).append(shard_day)
+                if len(shards[shard_day["date"]]) < counts[shard_day["date"]]:
+                    continue
+                day = merge_days(shards.pop(shard_day["date"]))
+                stages = day.pop("metrics", [])
+                if arguments.metrics is not None:
+                    db_stats.add_stages(stages)
+                if arguments.verbose:
+                    print "Storing", day["date"]
+                schema = jcd.dao.ShortSamplesDAO.get_schema_name(day["date"])
+                partitions.route(day["date"])
+                minmax = MinMax(db_stats, schema, arguments)
+                activity = Activity(db_stats, schema, arguments)
+                occupancy = Occupancy(db_stats, schema, arguments)
+                quantiles = Quantiles(db_stats, schema, arguments)
+                dirty = DirtyAggregates(db_stats, arguments)
+                with Transaction(db_stats):
+                    App._clear_incremental(db_stats, schema, arguments, day["date"])
+                    minmax.store_day(day)
+                    activity.store_day(day)
+                    occupancy.store_day(day)
+                    quantiles.store_day(day)
+                    dirty.mark(day["date"])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    @staticmethod
+    def _run_planned_aggregates(db_stats, arguments, partitions):
+        # run once every day they depend on is stored, only for the
+        # periods marked dirty, each being rebuilt and ranked only once
+        dirty = DirtyAggregates(db_stats, arguments)
+        for level in DirtyAggregates.Levels:
+            for mark in list(dirty.get_pending(level)):
+                date = mark["date"]
+                if arguments.verbose:
+                    print "Aggregating", level, "of", date
+                schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+                partitions.route(date)
+                minmax = MinMax(db_stats, schema, arguments)
+                activity = Activity(db_stats, schema, arguments)
+                occupancy = Occupancy(db_stats, schema, arguments)
+                quantiles = Quantiles(db_stats, schema, arguments)
+                with Transaction(db_stats):
+                    if level == "day":
+                        minmax.run_day_aggregates(date)
+                        activity.run_day_aggregates(date)
+                        occupancy.run_aggregates(date)
+                    else:
+                        getattr(minmax, "run_%s_aggregates" % level)(date)
+                        getattr(activity, "run_%s_aggregates" % level)(date)
+                        getattr(quantiles, "run_%s_aggregates" % level)(date)
+                    dirty.clear(level, mark["period"])
+
+    def _get_dates(self, arguments):
+        dates = list(arguments.date)
+        if arguments.date_from is None and arguments.date_to is None:
+            if len(dates) == 0 and not (arguments.list_dirty or arguments.aggregate_dirty or
+                                        arguments.watch or arguments.migrate_compact):
+                self._parser.error("at least one date or a --from/--to range is required")
+            return dates
+        if arguments.date_from is None or arguments.date_to is None:
+            self._parser.error("--from and --to must be used together")
+        try:
+            current = datetime.datetime.strptime(arguments.date_from, "%Y-%m-%d").date()
+            last = datetime.datetime.strptime(arguments.date_to, "%Y-%m-%d").date()
+        except ValueError as error:
+            self._parser.error("invalid range date: %s" % error)
+        if current > last:
+            self._parser.error("--from must not be after --to")
+        while current <= last:
+            date = current.strftime("%Y-%m-%d")
+            current += datetime.timedelta(days=1)
+            # days without samples are holes of the range
+            schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+            filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
+            if not os.path.exists(os.path.join(os.path.expanduser(arguments.datadir), filename)):
+                if arguments.verbose:
+                    print "Skipping", date, "without sample db"
+                continue
+            dates.append(date)
+        return dates
+
+    def _run_dates(self, db_stats, arguments, planned, partitions):
+        # sample files are checked before processing, so that any
+        # change happening during processing is seen on next run
+        manifest = Manifest(db_stats, arguments)
+        states = []
+        dates = []
+        for date in arguments.date:
+            state = manifest.get_file_state(date)
+            if state is not None:
+                if not arguments.force and manifest.is_unchanged(state):
+                    if arguments.verbose:
+                        print "Skipping unchanged", date
+                    continue
+                states.append(state)
+            dates.append(date)
+        arguments.date = dates
+        # not used by stages, attached once for the whole run
+        db_stats.attach_database(arguments.appdbname, "app", arguments.datadir)
+        try:
+            if arguments.jobs > 1:
+                self._run_parallel(db_stats, arguments, partitions)
+            else:
+                self._run_serial(db_stats, arguments, planned, partitions)
+            if planned:
+                self._run_planned_aggregates(db_stats, arguments, partitions)
+        finally:
+            partitions.close()
+            db_stats.detach_database("app")
+        with Transaction(db_stats):
+            manifest.store(states)
+
+    @staticmethod
+    def _get_sample_dates(arguments):
+        # dates of the daily sample dbs found in the data folder
+        dates = []
+        for filename in sorted(os.listdir(os.path.expanduser(arguments.datadir))):
+            match = re.search(r"(\d{4})\D?(\d{2})\D?(\d{2})", filename)
+            if match is None:
+                continue
+            date = "-".join(match.groups())
+            schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+            if jcd.dao.ShortSamplesDAO.get_db_file_name(schema) == filename:
+                dates.append(date)
+        return dates
+
+    def _watch_cycle(self, db_stats, arguments, planned, partitions, manifest):
+        arguments.date = []
+        for date in self._get_sample_dates(arguments):
+            state = manifest.get_file_state(date)
+            if state is not None and not manifest.is_unchanged(state):
+                arguments.date.append(date)
+        if len(arguments.date) == 0:
+            return
+        if arguments.verbose:
+            print "Changed sample dbs for", ", ".join(arguments.date)
+        try:
+            self._run_dates(db_stats, arguments, planned, partitions)
+        finally:
+            if arguments.metrics is not None:
+                db_stats.write()
+                db_stats.reset()
+
+    def _watch(self, db_stats, arguments, planned, partitions):
+        # the stats connection and the known tables are kept from one check
+        # to the next; statements are only reused through the implicit
+        # per connection cache of sqlite3, for identical statement texts
+        manifest = Manifest(db_stats, arguments)
+        while True:
+            try:
+                self._watch_cycle(db_stats, arguments, planned, partitions, manifest)
+            except Exception as error:
+                # failed dates were rolled back and the manifest was not
+                # updated, so they are processed again on next check
+                print >>sys.stderr, "Watch cycle failed:", error
+            time.sleep(arguments.watch_interval)
+
     def run(self):
         # parse arguments
         arguments = self._parser.parse_args()
+        if arguments.jobs < 1:
+            self._parser.error("--jobs must be at least 1")
+        if arguments.shards < 1:
+            self._parser.error("--shards must be at least 1")
+        if arguments.shards > 1 and arguments.jobs < 2:
+            self._parser.error("--shards requires --jobs to be greater than 1")
+        if arguments.quantile_width < 1:
+            self._parser.error("--quantile-width must be at least 1")
+        if arguments.watch and (len(arguments.date) > 0 or arguments.date_from is not None):
+            self._parser.error("--watch processes every date of the data folder, no date can be given")
+        if arguments.watch_interval < 1:
+            self._parser.error("--watch-interval must be at least 1")
+        parallel = arguments.jobs > 1
+        if arguments.incremental and parallel:
+            self._parser.error("--incremental can not be used with --jobs or --shards")
+        if arguments.change_log and (arguments.incremental or parallel):
+            self._parser.error("--change-log can not be used with --incremental, --jobs or --shards")
+        if arguments.count != "samples" and not arguments.change_log:
+            self._parser.error("--count requires --change-log")
+        if arguments.partition != "none" and arguments.migrate_compact:
+            self._parser.error("--migrate-compact can not be used with --partition")
+        # ranges and parallel runs use the aggregates planner
+        planned = arguments.date_from is not None or parallel
+        arguments.date = self._get_dates(arguments)
         with jcd.common.SqliteDB(arguments.statdbname, arguments.datadir) as db_stats:
-            for date in arguments.date:
-                if arguments.verbose:
-                    print "Processing", date
-                # attach db
-                schema = jcd.dao.ShortSamplesDAO.get_schema_name(date)
-                filename = jcd.dao.ShortSamplesDAO.get_db_file_name(schema)
-                db_stats.attach_database(filename, schema, arguments.datadir)
-                db_stats.attach_database(arguments.appdbname, "app", arguments.datadir)
-                # do processing
-                MinMax(db_stats, schema, arguments).run(date)
-                Activity(db_stats, schema, arguments).run(date)
-                # detach db
-                db_stats.detach_database("app")
-                db_stats.detach_database(schema)
+            set_autocommit(db_stats)
+            apply_profile(db_stats, arguments.profile, arguments.verbose)
+            db_stats = TableCache(db_stats)
+            if db_stats.has_table(CompactLayout.KeysTable):
+                # compact station views and their facts are not partitioned
+                if arguments.partition != "none":
+                    self._parser.error("--partition can not be used with a compact stats db")
+                # writes to station views are counted from their triggers
+                db_stats = CompactWrites(db_stats)
+            if arguments.metrics is not None:
+                db_stats = Instrumentation(db_stats, arguments)
+            try:
+                partitions = Partitions(db_stats, arguments)
+                if arguments.migrate_compact:
+                    CompactLayout(db_stats, arguments).migrate()
+                elif arguments.watch:
+                    self._watch(db_stats, arguments, planned, partitions)
+                elif arguments.list_dirty:
+                    DirtyAggregates(db_stats, arguments).report()
+                elif arguments.aggregate_dirty:
+                    db_stats.attach_database(arguments.appdbname, "app", arguments.datadir)
+                    self._run_planned_aggregates(db_stats, arguments, partitions)
+                    partitions.close()
+                    db_stats.detach_database("app")
+                else:
+                    self._run_dates(db_stats, arguments, planned, partitions)
+            finally:
+                if arguments.metrics is not None:
+                    db_stats.write()
 
 # main
 if __name__ == '__main__':
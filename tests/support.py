@@ -0,0 +1,88 @@
+import os
+import re
+import sys
+import glob
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import unittest
+import subprocess
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if Root not in sys.path:
+    sys.path.insert(0, Root)
+
+import jcdbench
+
+# two weeks and two months are covered by the rollups
+Dates = ["2016-02-28", "2016-02-29", "2016-03-01"]
+
+# bookkeeping tables of a mode, not part of the stats
+IgnoredTables = re.compile(r"^(manifest_|dirty_|incremental_|changes_|stations_keys$)|_facts$")
+
+def generate(datadir, dates, seed="tests"):
+    arguments = argparse.Namespace(
+        datadir=datadir,
+        samples=48,
+        contracts=3,
+        stations=6,
+        change_ratio=0.5,
+        seed=seed,
+        verbose=False)
+    generator = jcdbench.Generator(arguments)
+    for date in dates:
+        generator.run(date)
+
+def get_sample_path(datadir, date):
+    return os.path.join(datadir, "samples_%s.db" % date.replace("-", "_"))
+
+def run_stats(datadir, statdbname, *args):
+    # the batch is run as a script, so that nothing is shared between runs
+    command = [sys.executable, os.path.join(Root, "jcdstats.py"),
+               "--datadir", datadir, "--statdbname", statdbname] + list(args)
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(command, stdout=devnull)
+
+def dump_stats(datadir, statdbname):
+    # year partitions are read as if they were part of the stats db
+    base, extension = os.path.splitext(statdbname)
+    paths = [os.path.join(datadir, statdbname)] + sorted(
+        glob.glob(os.path.join(datadir, "%s_[0-9][0-9][0-9][0-9]%s" % (base, extension))))
+    tables = {}
+    for path in paths:
+        connection = sqlite3.connect(path)
+        try:
+            names = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')").fetchall()
+            for (name,) in names:
+                if IgnoredTables.search(name):
+                    continue
+                rows = connection.execute("SELECT * FROM %s" % name).fetchall()
+                tables.setdefault(name, []).extend(rows)
+        finally:
+            connection.close()
+    return dict((name, sorted(rows)) for name, rows in tables.iteritems())
+
+class StatsTestCase(unittest.TestCase):
+
+    dates = Dates
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp(prefix="jcdstats_tests_")
+        generate(self.datadir, self.dates)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def run_stats(self, statdbname, *args):
+        run_stats(self.datadir, statdbname, *args)
+        return dump_stats(self.datadir, statdbname)
+
+    def get_reference(self):
+        return self.run_stats("reference.db", *self.dates)
+
+    def assertSameStats(self, expected, actual):
+        self.assertEqual(sorted(expected), sorted(actual))
+        for table_name in sorted(expected):
+            self.assertEqual(expected[table_name], actual[table_name], "table %s differs" % table_name)
@@ -0,0 +1,29 @@
+import os
+import sqlite3
+import unittest
+
+from tests import support
+
+class ChangeLogTest(support.StatsTestCase):
+
+    def test_change_log(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("changes.db", "--change-log", *self.dates))
+
+    def test_change_log_scan(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats(
+            "changes.db", "--change-log", "--engine", "scan", *self.dates))
+
+    def test_not_persisted(self):
+        self.run_stats("changes.db", "--change-log", *self.dates)
+        connection = sqlite3.connect(os.path.join(self.datadir, "changes.db"))
+        try:
+            tables = connection.execute(
+                "SELECT name FROM sqlite_master WHERE name LIKE 'changes_%'").fetchall()
+        finally:
+            connection.close()
+        self.assertEqual([], tables)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import json
+import sqlite3
+import unittest
+
+import jcd.common
+
+from tests import support
+
+import jcdstats
+
+class CompactTest(support.StatsTestCase):
+
+    def _migrate(self, statdbname):
+        self.run_stats(statdbname, self.dates[0])
+        self.run_stats(statdbname, "--migrate-compact")
+
+    def _connect(self, statdbname):
+        return sqlite3.connect(os.path.join(self.datadir, statdbname))
+
+    def test_compact(self):
+        expected = self.get_reference()
+        self._migrate("compact.db")
+        self.assertSameStats(expected, self.run_stats("compact.db", "--force", *self.dates))
+
+    def test_rows_written(self):
+        self._migrate("compact.db")
+        metrics = os.path.join(self.datadir, "metrics.jsonl")
+        self.run_stats("compact.db", "--force", "--metrics", metrics, self.dates[1])
+        with open(metrics) as metrics_file:
+            stages = [json.loads(line) for line in metrics_file]
+        written = dict((stage["stage"], stage["rows_written"]) for stage in stages)
+        connection = self._connect("compact.db")
+        try:
+            stations = connection.execute(
+                '''
+                SELECT COUNT(*)
+                FROM minmax_stations_day
+                WHERE start_of_day = strftime('%s', ?)
+                ''', (self.dates[1],)).fetchone()[0]
+        finally:
+            connection.close()
+        self.assertGreater(stations, 0)
+        self.assertEqual(stations, written["minmax_stations"])
+
+    def test_other_writes(self):
+        # statements not writing compact views are not counted again
+        self._migrate("compact.db")
+        with jcd.common.SqliteDB("compact.db", self.datadir) as db:
+            queries = []
+            execute_fetch_generator = db.execute_fetch_generator
+            def record(sql, *args):
+                queries.append(sql)
+                return execute_fetch_generator(sql, *args)
+            db.execute_fetch_generator = record
+            writes = jcdstats.CompactWrites(db)
+            writes.execute_single("CREATE TEMP TABLE other (id INTEGER)", None, "create")
+            self.assertEqual(2, writes.execute_many("INSERT INTO temp.other VALUES (?)", [(1,), (2,)], "insert"))
+            self.assertEqual([], queries)
+            writes.execute_single("UPDATE activity_stations_day SET num_changes = num_changes", None, "update")
+            self.assertEqual(2, len(queries))
+
+    def test_update(self):
+        self._migrate("compact.db")
+        connection = self._connect("compact.db")
+        try:
+            before = connection.execute(
+                "SELECT SUM(num_changes) FROM activity_stations_day").fetchone()[0]
+            connection.execute(
+                "UPDATE activity_stations_day SET num_changes = num_changes + 1")
+            after = connection.execute(
+                "SELECT SUM(num_changes) FROM activity_stations_day").fetchone()[0]
+            rows = connection.execute(
+                "SELECT COUNT(*) FROM activity_stations_day").fetchone()[0]
+        finally:
+            connection.close()
+        self.assertGreater(rows, 0)
+        self.assertEqual(before + rows, after)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import sqlite3
+import unittest
+import subprocess
+
+from tests import support
+
+# the batch stops once the days are stored, before their aggregates
+StopScript = '''
+import sys
+sys.path.insert(0, %r)
+import jcdstats
+def stop(db_stats, arguments, partitions):
+    sys.exit(3)
+jcdstats.App._run_planned_aggregates = staticmethod(stop)
+jcdstats.App("~/.jcd_v2", "stats.db", "app.db").run()
+''' % support.Root
+
+class DirtyTest(support.StatsTestCase):
+
+    def _run_output(self, statdbname, *args):
+        command = [sys.executable, os.path.join(support.Root, "jcdstats.py"),
+                   "--datadir", self.datadir, "--statdbname", statdbname] + list(args)
+        return subprocess.check_output(command).splitlines()
+
+    def _remove_afternoon(self, path, date):
+        # samples of the afternoon arrive late
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute(
+                "DELETE FROM archived_samples WHERE timestamp >= strftime('%s', ?, '+12 hours')",
+                (date,))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def test_aggregate_dirty(self):
+        expected = self.get_reference()
+        date = self.dates[1]
+        path = support.get_sample_path(self.datadir, date)
+        with open(path, "rb") as sample_file:
+            content = sample_file.read()
+        self._remove_afternoon(path, date)
+        self.run_stats("dirty.db", *self.dates)
+        with open(path, "wb") as sample_file:
+            sample_file.write(content)
+        command = [sys.executable, "-c", StopScript,
+                   "--datadir", self.datadir, "--statdbname", "dirty.db",
+                   "--from", date, "--to", date]
+        with open(os.devnull, "w") as devnull:
+            self.assertEqual(3, subprocess.call(command, stdout=devnull))
+        # only the periods of the date are pending, 2016-02-29 is a monday
+        self.assertEqual([
+            "day   2016-02-29 (from 2016-02-29)",
+            "week  2016-02-29 (from 2016-02-29)",
+            "month 2016-02-01 (from 2016-02-29)",
+            "year  2016-01-01 (from 2016-02-29)"
+        ], self._run_output("dirty.db", "--list-dirty"))
+        self._run_output("dirty.db", "--aggregate-dirty")
+        self.assertSameStats(expected, support.dump_stats(self.datadir, "dirty.db"))
+        self.assertEqual(["No pending aggregates"], self._run_output("dirty.db", "--list-dirty"))
+
+if __name__ == '__main__':
+    unittest.main()
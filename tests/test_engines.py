@@ -0,0 +1,19 @@
+import unittest
+
+from tests import support
+
+import jcdstats
+
+class EnginesTest(support.StatsTestCase):
+
+    def test_scan(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("scan.db", "--engine", "scan", *self.dates))
+
+    @unittest.skipUnless(jcdstats.numpy is not None, "numpy is not installed")
+    def test_numpy(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("numpy.db", "--engine", "numpy", *self.dates))
+
+if __name__ == '__main__':
+    unittest.main()
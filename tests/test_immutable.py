@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+import unittest
+import subprocess
+
+from tests import support
+
+import jcdstats
+
+@unittest.skipUnless(jcdstats.HasUriFilenames, "sqlite built without uri filenames")
+class ImmutableTest(support.StatsTestCase):
+
+    def _run_verbose(self, statdbname):
+        command = [sys.executable, os.path.join(support.Root, "jcdstats.py"),
+                   "--datadir", self.datadir, "--statdbname", statdbname, "--verbose"] + self.dates
+        return subprocess.check_output(command)
+
+    def _set_age(self, seconds):
+        mtime = time.time() - seconds
+        for date in self.dates:
+            os.utime(support.get_sample_path(self.datadir, date), (mtime, mtime))
+
+    def test_recently_changed(self):
+        # late samples may still be added to these dbs
+        self._set_age(jcdstats.ImmutableGracePeriod - 3600)
+        self.assertNotIn("as immutable", self._run_verbose("recent.db"))
+
+    def test_closed(self):
+        expected = self.get_reference()
+        self._set_age(jcdstats.ImmutableGracePeriod + 3600)
+        self.assertEqual(len(self.dates), self._run_verbose("closed.db").count("as immutable"))
+        self.assertSameStats(expected, support.dump_stats(self.datadir, "closed.db"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import sqlite3
+import unittest
+
+from tests import support
+
+class IncrementalTest(support.StatsTestCase):
+
+    dates = ["2016-03-01"]
+
+    def _keep_samples(self, where):
+        # the sample db of the date only holds part of the day
+        path = support.get_sample_path(self.datadir, self.dates[0])
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("DELETE FROM archived_samples WHERE NOT (%s)" % where)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _run_partial(self, where):
+        path = support.get_sample_path(self.datadir, self.dates[0])
+        with open(path, "rb") as sample_file:
+            content = sample_file.read()
+        self._keep_samples(where)
+        self.run_stats("incremental.db", "--incremental", "--force", *self.dates)
+        with open(path, "wb") as sample_file:
+            sample_file.write(content)
+        return self.run_stats("incremental.db", "--incremental", "--force", *self.dates)
+
+    def test_refresh(self):
+        expected = self.get_reference()
+        actual = self._run_partial("timestamp < strftime('%s', '2016-03-01 12:00')")
+        self.assertSameStats(expected, actual)
+
+    def test_contract_joining_later(self):
+        expected = self.get_reference()
+        actual = self._run_partial(
+            "timestamp < strftime('%s', '2016-03-01 12:00') AND contract_id != 3")
+        self.assertSameStats(expected, actual)
+
+if __name__ == '__main__':
+    unittest.main()
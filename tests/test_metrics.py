@@ -0,0 +1,33 @@
+import os
+import json
+import unittest
+
+from tests import support
+
+class MetricsTest(support.StatsTestCase):
+
+    def _get_stages(self, *args):
+        metrics = os.path.join(self.datadir, "metrics.jsonl")
+        self.run_stats("metrics.db", "--metrics", metrics, *(args + tuple(self.dates)))
+        with open(metrics) as metrics_file:
+            return [json.loads(line) for line in metrics_file]
+
+    def test_full_rollup(self):
+        names = set(stage["stage"] for stage in self._get_stages())
+        self.assertNotIn("activity_previous_day", names)
+        self.assertNotIn("activity_delta_rollup", names)
+
+    def test_delta_rollup(self):
+        stages = self._get_stages("--rollup", "delta")
+        names = [stage["stage"] for stage in stages]
+        self.assertEqual(len(self.dates), names.count("activity_previous_day"))
+        self.assertEqual(len(self.dates), names.count("activity_delta_rollup"))
+
+    def test_rows_fetched(self):
+        # rows read by insert select statements are not fetched
+        stages = dict((stage["stage"], stage) for stage in self._get_stages())
+        self.assertEqual(0, stages["activity_stations_day"]["rows_fetched"])
+        self.assertGreater(stages["activity_stations_day"]["rows_written"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
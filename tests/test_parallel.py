@@ -0,0 +1,22 @@
+import unittest
+
+from tests import support
+
+class ParallelTest(support.StatsTestCase):
+
+    def test_jobs(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("jobs.db", "--jobs", "2", *self.dates))
+
+    def test_shards(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats(
+            "shards.db", "--jobs", "2", "--shards", "2", *self.dates))
+
+    def test_more_shards_than_contracts(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats(
+            "shards.db", "--jobs", "2", "--shards", "5", *self.dates))
+
+if __name__ == '__main__':
+    unittest.main()
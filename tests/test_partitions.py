@@ -0,0 +1,53 @@
+import argparse
+import unittest
+import subprocess
+
+import jcd.common
+
+from tests import support
+
+import jcdstats
+
+class PartitionsTest(support.StatsTestCase):
+
+    # weeks and trailing windows cross the year
+    dates = ["2015-12-31", "2016-01-01", "2016-01-04"]
+
+    def test_partition(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("partitioned.db", "--partition", "year", *self.dates))
+
+    def test_migrate(self):
+        expected = self.get_reference()
+        self.run_stats("partitioned.db", *self.dates[:2])
+        self.assertSameStats(expected, self.run_stats(
+            "partitioned.db", "--partition", "year", *self.dates[2:]))
+
+    def test_compact_rejected(self):
+        self.run_stats("compact.db", self.dates[0])
+        self.run_stats("compact.db", "--migrate-compact")
+        expected = support.dump_stats(self.datadir, "compact.db")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_stats("compact.db", "--partition", "year", *self.dates[1:])
+        self.assertSameStats(expected, support.dump_stats(self.datadir, "compact.db"))
+
+    def test_reader(self):
+        self.run_stats("partitioned.db", "--partition", "year", *self.dates)
+        expected = self.get_reference()
+        arguments = argparse.Namespace(
+            datadir=self.datadir,
+            statdbname="partitioned.db",
+            partition="year",
+            verbose=False)
+        with jcd.common.SqliteDB("partitioned.db", self.datadir) as db:
+            partitions = jcdstats.Partitions(db, arguments, False)
+            self.assertEqual([2015, 2016], partitions.get_years())
+            partitions.open(partitions.get_years())
+            for table_name in jcdstats.Partitions.PartitionedTables:
+                rows = db.execute_fetch_generator(
+                    "SELECT * FROM %s" % table_name, None, "Error reading [%s]" % table_name)
+                self.assertEqual(expected[table_name], sorted(tuple(row) for row in rows))
+            partitions.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import argparse
+import unittest
+
+import jcd.common
+
+from tests import support
+
+import jcdquery
+import jcdstats
+
+class RankCacheTest(unittest.TestCase):
+
+    def test_least_recently_used(self):
+        cache = jcdquery.RankCache(2)
+        cache.put("a", "query", [1])
+        cache.put("b", "query", [2])
+        self.assertEqual([1], cache.get("a", "query"))
+        cache.put("c", "query", [3])
+        self.assertIsNone(cache.get("b", "query"))
+        self.assertEqual([1], cache.get("a", "query"))
+        self.assertEqual([3], cache.get("c", "query"))
+        self.assertIsNone(cache.get("a", "other query"))
+
+    def test_clear(self):
+        cache = jcdquery.RankCache(2)
+        cache.put("a", "query", [1])
+        cache.clear()
+        self.assertIsNone(cache.get("a", "query"))
+
+class ActivityQueryTest(support.StatsTestCase):
+
+    columns = ["contract_id", "station_number", "num_changes", "rank_contract", "rank_global"]
+
+    # the week of the first of january starts in the previous year
+    dates = ["2015-12-31", "2016-01-01", "2016-01-04"]
+
+    def _get_arguments(self, statdbname):
+        return argparse.Namespace(
+            datadir=self.datadir,
+            statdbname=statdbname,
+            partition="year",
+            verbose=False)
+
+    def _open_query(self, db, statdbname):
+        partitions = jcdstats.Partitions(db, self._get_arguments(statdbname), False)
+        if len(partitions.get_years()) == 0:
+            partitions = None
+        return jcdquery.ActivityQuery(db, jcdquery.RankCache(16), partitions)
+
+    def _get_expected(self, period, date):
+        # read straight from the single file stats db
+        stations_table, contracts_table, time_key_name = jcdquery.Periods[period]
+        connection = sqlite3.connect(os.path.join(self.datadir, "reference.db"))
+        try:
+            return connection.execute(
+                '''
+                SELECT %s
+                FROM %s
+                WHERE %s = ?
+                ORDER BY rank_global, contract_id, station_number
+                LIMIT 5
+                ''' % (", ".join(self.columns), stations_table, time_key_name),
+                (jcdquery.get_period_start(period, date),)).fetchall()
+        finally:
+            connection.close()
+
+    def _add_changes(self, filename, period, date):
+        # written by another connection, as a batch would
+        stations_table, contracts_table, time_key_name = jcdquery.Periods[period]
+        connection = sqlite3.connect(os.path.join(self.datadir, filename))
+        try:
+            connection.execute(
+                "UPDATE %s SET num_changes = num_changes + 1000 WHERE %s = ?" % (
+                    stations_table, time_key_name),
+                (jcdquery.get_period_start(period, date),))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def _assert_results(self, statdbname):
+        with jcd.common.SqliteDB(statdbname, self.datadir) as db:
+            query = self._open_query(db, statdbname)
+            for period in sorted(jcdquery.Periods):
+                for date in self.dates:
+                    rows = query.get_top_stations(period, date, 5)
+                    self.assertEqual(
+                        self._get_expected(period, date),
+                        [tuple(row[column] for column in self.columns) for row in rows],
+                        "%s of %s differs" % (period, date))
+
+    def _assert_invalidated(self, statdbname, filename):
+        with jcd.common.SqliteDB(statdbname, self.datadir) as db:
+            query = self._open_query(db, statdbname)
+            before = query.get_top_stations("week", "2016-01-01", 5)
+            self.assertGreater(len(before), 0)
+            self._add_changes(filename, "week", "2016-01-01")
+            after = query.get_top_stations("week", "2016-01-01", 5)
+        self.assertEqual(
+            [row["num_changes"] + 1000 for row in before],
+            [row["num_changes"] for row in after])
+
+    def test_shared_cache(self):
+        self.get_reference()
+        self.run_stats("other.db", *self.dates)
+        self._add_changes("other.db", "week", "2016-01-01")
+        cache = jcdquery.RankCache(16)
+        with jcd.common.SqliteDB("reference.db", self.datadir) as db:
+            before = jcdquery.ActivityQuery(db, cache).get_top_stations("week", "2016-01-01", 5)
+        with jcd.common.SqliteDB("other.db", self.datadir) as db:
+            other = jcdquery.ActivityQuery(db, cache).get_top_stations("week", "2016-01-01", 5)
+        self.assertEqual(
+            [row["num_changes"] + 1000 for row in before],
+            [row["num_changes"] for row in other])
+
+    def test_results(self):
+        self.get_reference()
+        self._assert_results("reference.db")
+
+    def test_partitioned_results(self):
+        self.get_reference()
+        self.run_stats("partitioned.db", "--partition", "year", *self.dates)
+        self._assert_results("partitioned.db")
+
+    def test_invalidated(self):
+        self.get_reference()
+        self._assert_invalidated("reference.db", "reference.db")
+
+    def test_partitioned_invalidated(self):
+        self.run_stats("partitioned.db", "--partition", "year", *self.dates)
+        self._assert_invalidated("partitioned.db", "partitioned_2015.db")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import json
+import sqlite3
+import unittest
+
+from tests import support
+
+import jcdstats
+
+class RollupTest(support.StatsTestCase):
+
+    def test_delta(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats("delta.db", "--rollup", "delta", *self.dates))
+
+    def test_delta_refresh(self):
+        # a date processed again only adds its difference to the periods
+        expected = self.get_reference()
+        path = support.get_sample_path(self.datadir, self.dates[1])
+        with open(path, "rb") as sample_file:
+            content = sample_file.read()
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute(
+                "DELETE FROM archived_samples WHERE timestamp >= strftime('%s', ?, '+12 hours')",
+                (self.dates[1],))
+            connection.commit()
+        finally:
+            connection.close()
+        self.run_stats("delta.db", "--rollup", "delta", *self.dates)
+        with open(path, "wb") as sample_file:
+            sample_file.write(content)
+        self.assertSameStats(expected, self.run_stats(
+            "delta.db", "--rollup", "delta", "--force", self.dates[1]))
+
+    def test_range(self):
+        # rollups of the range are coalesced by the planner
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats(
+            "range.db", "--from", self.dates[0], "--to", self.dates[-1]))
+
+    def test_range_trailing_once(self):
+        # each trailing window of a forced range is rebuilt once
+        expected = self.get_reference()
+        self.run_stats("range.db", "--from", self.dates[0], "--to", self.dates[-1])
+        metrics = os.path.join(self.datadir, "metrics.jsonl")
+        actual = self.run_stats(
+            "range.db", "--force", "--metrics", metrics, "--from", self.dates[0], "--to", self.dates[-1])
+        self.assertSameStats(expected, actual)
+        with open(metrics) as metrics_file:
+            stages = [json.loads(line)["stage"] for line in metrics_file]
+        for days, stations_table, contracts_table in jcdstats.Activity.TrailingTables:
+            self.assertEqual(len(self.dates), stages.count(stations_table))
+
+    def test_range_hole(self):
+        # days of the range without a sample db are skipped
+        os.remove(support.get_sample_path(self.datadir, self.dates[1]))
+        expected = self.run_stats("reference.db", self.dates[0], self.dates[2])
+        self.assertSameStats(expected, self.run_stats(
+            "range.db", "--from", self.dates[0], "--to", self.dates[-1]))
+
+    def test_range_delta(self):
+        expected = self.get_reference()
+        self.assertSameStats(expected, self.run_stats(
+            "range.db", "--rollup", "delta", "--from", self.dates[0], "--to", self.dates[-1]))
+
+if __name__ == '__main__':
+    unittest.main()
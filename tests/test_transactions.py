@@ -0,0 +1,47 @@
+import os
+import sys
+import signal
+import unittest
+import subprocess
+
+from tests import support
+
+# the batch is killed once the other stages wrote the second date
+KillScript = '''
+import os
+import sys
+import signal
+sys.path.insert(0, %r)
+import jcdstats
+run_day = jcdstats.Quantiles.run_day
+dates = []
+def kill_run_day(self, date):
+    dates.append(date)
+    if len(dates) == 2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return run_day(self, date)
+jcdstats.Quantiles.run_day = kill_run_day
+jcdstats.App("~/.jcd_v2", "stats.db", "app.db").run()
+''' % support.Root
+
+class TransactionTest(support.StatsTestCase):
+
+    def test_killed_mid_date(self):
+        # query plans are explained between writes, and python 2 sqlite3
+        # commits before such statements unless transactions are explicit
+        metrics = os.path.join(self.datadir, "metrics.jsonl")
+        command = [sys.executable, "-c", KillScript,
+                   "--datadir", self.datadir, "--statdbname", "killed.db",
+                   "--metrics", metrics, "--metrics-plans"] + self.dates
+        with open(os.devnull, "w") as devnull:
+            returncode = subprocess.call(command, stdout=devnull)
+        self.assertEqual(-signal.SIGKILL, returncode)
+        # only the first date is visible, as if it had been run alone
+        expected = self.run_stats("first.db", self.dates[0])
+        actual = support.dump_stats(self.datadir, "killed.db")
+        self.assertSameStats(expected, actual)
+        # and the next run completes the others
+        self.assertSameStats(self.get_reference(), self.run_stats("killed.db", *self.dates))
+
+if __name__ == '__main__':
+    unittest.main()
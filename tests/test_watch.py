@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+import sqlite3
+import unittest
+import subprocess
+
+from tests import support
+
+class WatchTest(support.StatsTestCase):
+
+    def _get_manifest_dates(self, statdbname):
+        path = os.path.join(self.datadir, statdbname)
+        if not os.path.exists(path):
+            return []
+        connection = sqlite3.connect(path)
+        try:
+            return [row[0] for row in connection.execute(
+                "SELECT date FROM manifest_samples_day ORDER BY date")]
+        except sqlite3.OperationalError:
+            return []
+        finally:
+            connection.close()
+
+    def test_failed_cycle(self):
+        expected = self.get_reference()
+        # an unreadable sample db fails the first checks
+        corrupt = support.get_sample_path(self.datadir, "2016-02-27")
+        with open(corrupt, "wb") as sample_file:
+            sample_file.write("not a sqlite db" * 100)
+        command = [sys.executable, os.path.join(support.Root, "jcdstats.py"),
+                   "--datadir", self.datadir, "--statdbname", "watch.db",
+                   "--watch", "--watch-interval", "1"]
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        try:
+            time.sleep(2)
+            self.assertIsNone(process.poll())
+            os.remove(corrupt)
+            deadline = time.time() + 30
+            while self._get_manifest_dates("watch.db") != self.dates and time.time() < deadline:
+                time.sleep(0.5)
+            self.assertIsNone(process.poll())
+        finally:
+            process.kill()
+            process.wait()
+        self.assertEqual(self.dates, self._get_manifest_dates("watch.db"))
+        self.assertSameStats(expected, support.dump_stats(self.datadir, "watch.db"))
+
+if __name__ == '__main__':
+    unittest.main()